@@ -8,4 +8,4 @@ version = '1.dev'
 _ = numpy.newaxis
 __all__ = [ '_', 'numpy', 'core', 'numeric', 'element', 'function',
   'mesh', 'plot', 'library', 'topology', 'util', 'matrix', 'parallel', 'log',
-  'debug', 'cache', 'transform', 'rational' ]
+  'debug', 'cache', 'transform', 'rational', 'solver' ]
@@ -114,6 +114,205 @@ class CallDict( dict ):
       else 'effectivity %d%% (%d hits, %d misses)' % ( (100*self.hit)/(self.hit+len(self)), self.hit, len(self) )
 
 
+class LRUCache( object ):
+  '''Size bounded cache of function calls. Hashable arguments are keyed by
+  value, writeable arrays by a digest of their content, and all others, such
+  as read-only arrays, by identity, with a reference kept for the lifetime of
+  the entry such that identities cannot be recycled. Bound methods are keyed
+  by their instance and function. Cached arrays are made read-only as they are
+  shared by all callers. Once the cached values and the referenced arrays hold
+  more than maxbytes, least recently used entries are evicted. Entries are guarded by a lock such
+  that the cache can be shared by threads.'''
+
+  def __init__( self, maxbytes ):
+    'constructor'
+
+    import collections, threading
+    self.maxbytes = maxbytes
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.nbytes = 0
+    self.hit = 0
+    self.miss = 0
+    self.evicted = 0
+
+  def __call__( self, func, *args ):
+    '''cache(func,*args):
+    Execute func(*args) and cache the result.'''
+
+    key = _identitykey( func ), tuple( _identitykey(arg) for arg in args )
+    with self.lock:
+      entry = self.entries.pop( key, None )
+      if entry is not None:
+        self.hit += 1
+        self.entries[key] = entry
+        return entry[0]
+      self.miss += 1
+    value = func( *args ) # evaluated without lock, as func may use the cache
+    if isinstance( value, numpy.ndarray ):
+      value.flags.writeable = False
+    refs = (func,) + tuple( arg for arg in args if not isinstance( arg, numpy.ndarray ) or not arg.flags.writeable )
+    nbytes = _nbytes( value ) + sum( ref.nbytes for ref in refs if isinstance( ref, numpy.ndarray ) )
+    if nbytes > self.maxbytes:
+      log.warning( 'cache entry of %.1fMB exceeds cache size of %.1fMB and is not kept' % ( nbytes/2.**20, self.maxbytes/2.**20 ) )
+      return value
+    with self.lock:
+      entry = self.entries.pop( key, None )
+      if entry is not None: # concurrently added by another thread
+        self.nbytes -= entry[1]
+      while self.entries and self.nbytes + nbytes > self.maxbytes:
+        oldkey, ( oldvalue, oldnbytes, oldrefs ) = self.entries.popitem( last=False )
+        self.nbytes -= oldnbytes
+        self.evicted += 1
+      self.nbytes += nbytes
+      self.entries[key] = value, nbytes, refs
+    return value
+
+  def __len__( self ):
+    return len( self.entries )
+
+  def clear( self ):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def summary( self ):
+    return 'not used' if not self.hit + self.miss \
+      else 'effectivity %d%% (%d hits, %d misses, %d evictions, %d entries, %.1fMB held)' % ( (100*self.hit)/(self.hit+self.miss), self.hit, self.miss, self.evicted, len(self.entries), self.nbytes/2.**20 )
+
+class OperationCache( object ):
+  '''Cache of values of evaluable operations by key, such as the element
+  transformation or None for constants. Operations are held weakly, such
+  that their values are dropped with them, and once the values hold more than
+  maxbytes, least recently used entries are evicted. Entries are guarded by a
+  lock such that the cache can be shared by threads. Missing entries raise
+  KeyError.'''
+
+  def __init__( self, maxbytes=None ):
+    'constructor'
+
+    import collections, threading
+    self.maxbytes = maxbytes
+    self.values = weakref.WeakKeyDictionary()
+    self.order = collections.OrderedDict() # (id(op),key) -> nbytes, least recently used first
+    self.refs = {} # id(op) -> weakref, for eviction
+    self.keys = {} # id(op) -> keys, for removal of dropped operations
+    self.dropped = [] # ids of dropped operations, appended by weakref callbacks
+    self.lock = threading.Lock()
+    self.nbytes = 0
+    self.evicted = 0
+
+  def __getitem__( self, item ):
+    op, key = item
+    with self.lock:
+      value = self.values[op][key]
+      self.order[id(op),key] = self.order.pop( (id(op),key) )
+    return value
+
+  def __setitem__( self, item, value ):
+    op, key = item
+    nbytes = _nbytes( value )
+    if self.maxbytes is not None and nbytes > self.maxbytes:
+      return
+    with self.lock:
+      self._purge()
+      values = self.values.get( op )
+      if values is None:
+        values = self.values[op] = {}
+        self.refs[id(op)] = weakref.ref( op, lambda ref, iop=id(op), dropped=self.dropped: dropped.append( iop ) )
+        self.keys[id(op)] = set()
+      if key in values:
+        self.nbytes -= self.order.pop( (id(op),key) )
+      values[key] = value
+      self.keys[id(op)].add( key )
+      self.order[id(op),key] = nbytes
+      self.nbytes += nbytes
+      while self.maxbytes is not None and self.nbytes > self.maxbytes:
+        ( iop, oldkey ), oldnbytes = self.order.popitem( last=False )
+        self.nbytes -= oldnbytes
+        self.evicted += 1
+        self.keys[iop].discard( oldkey )
+        oldop = self.refs[iop]()
+        if oldop is not None:
+          del self.values[oldop][oldkey]
+
+  def _purge( self ):
+    'remove the bookkeeping of dropped operations, lock held by caller'
+
+    while self.dropped:
+      iop = self.dropped.pop()
+      del self.refs[iop]
+      for key in self.keys.pop( iop ):
+        self.nbytes -= self.order.pop( (iop,key) )
+
+  def __len__( self ):
+    with self.lock:
+      return sum( len(values) for values in self.values.values() )
+
+  def clear( self ):
+    with self.lock:
+      self.values.clear()
+      self.order.clear()
+      self.refs.clear()
+      self.keys.clear()
+      del self.dropped[:]
+      self.nbytes = 0
+
+def _funcid( func ):
+  '''identity of func for FileCache: its module, qualified name and instance,
+  and for python functions a digest of the code along with the values of the
+  closure, such that lambdas and closures defined in the same function do not
+  share entries'''
+
+  function = getattr( func, '__func__', func )
+  funcid = getattr( func, '__module__', None ), getattr( function, '__qualname__', getattr( func, '__name__', None ) ), getattr( func, '__self__', None )
+  code = getattr( function, '__code__', None )
+  if code is None: # builtin
+    return funcid
+  closure = getattr( function, '__closure__', None ) or ()
+  return funcid + ( _codedigest( code ), tuple( cell.cell_contents for cell in closure ) )
+
+def _codedigest( code ):
+  'md5 digest of bytecode, constants and names, recursing into nested code'
+
+  import hashlib
+  digest = hashlib.md5( code.co_code )
+  for const in code.co_consts:
+    if isinstance( const, type(code) ):
+      text = _codedigest( const )
+    elif isinstance( const, frozenset ): # unordered
+      text = repr( sorted( repr(item) for item in const ) )
+    else:
+      text = repr( const )
+    digest.update( text.encode() )
+  digest.update( repr( code.co_names ).encode() )
+  return digest.hexdigest()
+
+_identity = object()
+_content = object()
+
+def _identitykey( obj ):
+  self = getattr( obj, '__self__', None )
+  if self is not None and hasattr( obj, '__func__' ): # bound method
+    return _identitykey( self ), obj.__func__
+  if isinstance( obj, numpy.ndarray ):
+    if not obj.flags.writeable:
+      return _identity, id(obj)
+    import hashlib
+    return _content, obj.dtype.str, obj.shape, hashlib.sha1( numpy.ascontiguousarray( obj ) ).digest()
+  try:
+    hash( obj )
+  except TypeError:
+    return _identity, id(obj)
+  return obj
+
+def _nbytes( obj ):
+  if isinstance( obj, numpy.ndarray ) or isinstance( getattr( obj, 'nbytes', None ), int ):
+    return obj.nbytes
+  if isinstance( obj, (tuple,list) ):
+    return sum( _nbytes(item) for item in obj )
+  return sys.getsizeof( obj )
+
 class ImmutableMeta( type ):
   def __init__( cls, *args, **kwargs ):
     type.__init__( cls, *args, **kwargs )
@@ -124,6 +323,10 @@ class ImmutableMeta( type ):
       self = cls.cache[key]
     except KeyError:
       self = type.__call__( cls, *args, **kwargs )
+      try:
+        self._immutableargs = key # for findargs without scanning the cache
+      except AttributeError:
+        pass # slotted class
       cls.cache[key] = self
     return self
 
@@ -134,6 +337,9 @@ except SyntaxError:
     __metaclass__ = ImmutableMeta
 
 def findargs( self ):
+  args = getattr( self, '_immutableargs', None )
+  if args is not None:
+    return args
   for args, obj in self.__class__.cache.items():
     if obj is self:
       return args
@@ -152,79 +358,173 @@ Immutable.__reduce__ = lambda self: ( self.__class__, findargs(self) )
 Immutable.__str__ = immutable_str
 
 class FileCache( object ):
-  'cache'
+  '''Persistent cache of function calls. Every call is stored in its own file
+  in directory cachedir, named after the md5 hash of the constructor
+  arguments, the function's module, qualified name, code and closure values,
+  and the call arguments, such that calls can be made in any order. Files are written to a temporary name
+  and moved into place, which makes concurrent writers (such as forked
+  workers) safe. Loading an entry updates its modification time, and after
+  writing, least recently used entries are evicted until the directory is
+  within cachesize megabytes. The recache property forces reevaluation.
+
+  Entries consist of an 8 byte length, a pickle, and raw npy blocks for all
+  numerical arrays of at least mmapsize bytes that are part of the result,
+  such as the data of a ScipyMatrix. On loading these arrays are memory
+  mapped copy-on-write, so that data is paged in only when accessed.'''
+
+  mmapsize = 2**16
 
   def __init__( self, *args ):
     'constructor'
 
-    if sys.version_info.major == 2:
-      self.init1( args )
-    else:
-      self.init2( args )
-
-  def init1( self, args ):
-    import os, numpy
-    self.myhash = hash( args )
-    hexhash = hex( self.myhash )[2:]
-    cachedir = core.getprop( 'cachedir', 'cache' )
-    if not os.path.exists( cachedir ):
-      os.makedirs( cachedir )
-    path = os.path.join( cachedir, hexhash )
-    allhash = numpy.array( [ hash(arg) for arg in args ], 'uint' )
-    if not os.path.isfile( path ) or core.getprop( 'recache', False ):
-      log.info( 'starting new cache:', hexhash )
-      data = open( path, 'wb+' )
-      allhash.tofile( data )
-    else:
-      log.info( 'continuing from cache:', hexhash )
-      data = open( path, 'ab+' )
-      checkhash = numpy.fromfile( data, 'uint', len(allhash) )
-      assert all( checkhash == allhash ), 'hash clash'
-    self.data = data
-
-  def init2( self, args ):
-    import os, numpy, hashlib, pickle
+    import hashlib
+    try:
+      import cPickle as pickle
+    except ImportError:
+      import pickle
     serial = pickle.dumps( args, -1 )
     self.myhash = hash( serial )
-    hexhash = hashlib.md5(serial).hexdigest()
-    cachedir = core.getprop( 'cachedir', 'cache' )
-    if not os.path.exists( cachedir ):
-      os.makedirs( cachedir )
-    path = os.path.join( cachedir, hexhash )
-    if not os.path.isfile( path ) or core.getprop( 'recache', False ):
-      log.info( 'starting new cache:', hexhash )
-      data = open( path, 'wb+' )
-      data.write( serial )
-      data.flush()
-    else:
-      log.info( 'continuing from cache:', hexhash )
-      data = open( path, 'ab+' )
-      data.seek(0)
-      recovered_args = pickle.load( data )
-      assert recovered_args == args, 'hash clash'
-    self.data = data
+    self.prefix = hashlib.md5( serial ).hexdigest()
+    self.cachedir = core.getprop( 'cachedir', 'cache' )
+    if not os.path.exists( self.cachedir ):
+      os.makedirs( self.cachedir )
+    self.maxsize = core.getprop( 'cachesize', 1024 ) * 2**20
+    self.recache = core.getprop( 'recache', False )
+    self.hit = 0
+    self.miss = 0
+    self.evicted = 0
+
+  def _key( self, func, args, kwargs ):
+    'hex digest identifying a call, or None if the arguments cannot be pickled'
+
+    import hashlib
+    try:
+      import cPickle as pickle
+    except ImportError:
+      import pickle
+    try:
+      serial = pickle.dumps( ( self.prefix, _funcid( func ), args, sorted( kwargs.items() ) ), -1 )
+    except Exception as e:
+      log.warning( 'not caching %s: %s' % ( getattr( func, '__name__', func ), e ) )
+      return None
+    return hashlib.md5( serial ).hexdigest()
 
   def __call__( self, func, *args, **kwargs ):
     'call'
 
+    name = func.__name__ + ''.join( ' %s' % arg for arg in args ) + ''.join( ' %s=%s' % item for item in kwargs.items() )
+    key = self._key( func, args, kwargs )
+    if key is None:
+      self.miss += 1
+      return func( *args, **kwargs )
+    path = os.path.join( self.cachedir, key )
+    if not self.recache:
+      try:
+        data, nbytes = self._read( path )
+      except ( IOError, OSError ):
+        pass # not in cache, or evicted by another process
+      except Exception as e:
+        log.warning( 'discarding corrupt cache entry %s: %s' % ( key, e ) )
+      else:
+        self.hit += 1
+        try:
+          os.utime( path, None )
+        except OSError:
+          pass
+        log.info( 'loaded from cache:', name, '[%db]' % nbytes )
+        return data
+    self.miss += 1
+    data = func( *args, **kwargs )
+    nbytes = self._write( path, data )
+    log.info( 'written to cache:', name, '[%db]' % nbytes )
+    self._evict()
+    return data
+
+  def _write( self, path, data ):
+    'atomically write data to path, return number of bytes'
+
+    import tempfile, io, struct
     try:
       import cPickle as pickle
     except ImportError:
       import pickle
-    name = func.__name__ + ''.join( ' %s' % arg for arg in args ) + ''.join( ' %s=%s' % item for item in kwargs.items() )
-    pos = self.data.tell()
+    arrays = []
+    def persistent_id( obj ):
+      if isinstance( obj, numpy.ndarray ) and not obj.dtype.hasobject and obj.nbytes >= self.mmapsize:
+        arrays.append( obj )
+        return len(arrays)-1
+      return None
+    serial = io.BytesIO()
+    pickler = pickle.Pickler( serial, -1 )
+    pickler.persistent_id = persistent_id
+    pickler.dump( data )
+    fd, tmppath = tempfile.mkstemp( dir=self.cachedir, prefix='.tmp' )
     try:
-      data = pickle.load( self.data )
-    except EOFError:
-      data = func( *args, **kwargs)
-      self.data.seek( pos )
-      pickle.dump( data, self.data, -1 )
-      self.data.flush()
-      msg = 'written to'
-    else:
-      msg = 'loaded from'
-    log.info( msg, 'cache:', name, '[%db]' % (self.data.tell()-pos) )
-    return data
+      with os.fdopen( fd, 'wb' ) as f:
+        f.write( struct.pack( '<Q', len(serial.getvalue()) ) )
+        f.write( serial.getvalue() )
+        for array in arrays:
+          numpy.lib.format.write_array( f, array )
+        nbytes = f.tell()
+      os.rename( tmppath, path )
+    except:
+      os.remove( tmppath )
+      raise
+    return nbytes
+
+  def _read( self, path ):
+    'load data from path, memory mapping array blocks; return data and number of bytes'
+
+    import io, struct
+    try:
+      import cPickle as pickle
+    except ImportError:
+      import pickle
+    arrays = []
+    with open( path, 'rb' ) as f:
+      n, = struct.unpack( '<Q', f.read( 8 ) )
+      serial = f.read( n )
+      assert len(serial) == n, 'truncated cache entry'
+      while f.read( 1 ):
+        f.seek( -1, 1 )
+        version = numpy.lib.format.read_magic( f )
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0( f ) if version == (1,0) \
+                                 else numpy.lib.format.read_array_header_2_0( f )
+        offset = f.tell()
+        arrays.append( numpy.memmap( path, dtype=dtype, mode='c', offset=offset, shape=shape, order='F' if fortran_order else 'C' ) )
+        f.seek( offset + arrays[-1].nbytes )
+      nbytes = f.tell()
+    unpickler = pickle.Unpickler( io.BytesIO( serial ) )
+    unpickler.persistent_load = lambda pid: arrays[pid]
+    return unpickler.load(), nbytes
+
+  def _evict( self ):
+    'remove least recently used entries until cache is within maxsize'
+
+    entries = []
+    for name in os.listdir( self.cachedir ):
+      if name.startswith( '.' ):
+        continue
+      try:
+        stat = os.stat( os.path.join( self.cachedir, name ) )
+      except OSError:
+        continue
+      entries.append(( stat.st_mtime, stat.st_size, name ))
+    size = sum( entry[1] for entry in entries )
+    for mtime, nbytes, name in sorted( entries ):
+      if size <= self.maxsize:
+        break
+      try:
+        os.remove( os.path.join( self.cachedir, name ) )
+      except OSError:
+        continue # removed by another process
+      size -= nbytes
+      self.evicted += 1
+      log.debug( 'evicted from cache:', name, '[%db]' % nbytes )
+
+  def summary( self ):
+    return 'not used' if not self.hit + self.miss \
+      else 'effectivity %d%% (%d hits, %d misses, %d evictions)' % ( (100*self.hit)/(self.hit+self.miss), self.hit, self.miss, self.evicted )
 
   def __hash__( self ):
     return self.myhash
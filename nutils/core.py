@@ -12,9 +12,10 @@ dependencies on other nutils modules. Primarily for internal use.
 """
 
 from __future__ import print_function, division
-import sys
+import sys, threading
 
 _nodefault = object()
+_thread = threading.local()
 def getprop( name, default=_nodefault ):
   """Access a semi-global property.
 
@@ -35,8 +36,8 @@ def getprop( name, default=_nodefault ):
 
   Returns:
       The object corresponding to the first __name__ encountered in a higher
-      scope. If none found, return default. If no default specified, raise
-      NameError.
+      scope, or else in the properties inherited by the current thread. If
+      none found, return default. If no default specified, raise NameError.
   """
 
   frame = sys._getframe(1)
@@ -45,9 +46,31 @@ def getprop( name, default=_nodefault ):
     if key in frame.f_locals:
       return frame.f_locals[key]
     frame = frame.f_back
+  properties = getattr( _thread, 'properties', {} )
+  if key in properties:
+    return properties[key]
   if default is _nodefault:
     raise NameError( 'property %r is not defined' % name )
   return default
 
 
+def inheritprops( properties ):
+  '''Make properties, a dictionary of __name__ keys such as collected by
+  getprops, accessible to getprop in the current thread.'''
+
+  _thread.properties = properties
+
+def getprops():
+  'dictionary of all properties accessible to getprop in the calling scope'
+
+  properties = dict( getattr( _thread, 'properties', {} ) )
+  frames = []
+  frame = sys._getframe(1)
+  while frame:
+    frames.append( frame )
+    frame = frame.f_back
+  for frame in reversed( frames ): # inner scopes take precedence
+    properties.update( ( key, value ) for key, value in frame.f_locals.items() if key.startswith( '__' ) and key.endswith( '__' ) and len(key) > 4 )
+  return properties
+
 # vim:shiftwidth=2:foldmethod=indent:foldnestmax=2
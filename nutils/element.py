@@ -18,7 +18,7 @@ purposes of integration and sampling.
 
 from __future__ import print_function, division
 from . import log, util, numpy, core, numeric, function, cache, transform, rational, _
-import re, warnings
+import re, warnings, weakref, threading
 
 
 ## ELEMENT
@@ -102,7 +102,27 @@ class Reference( cache.Immutable ):
   def simplices( self ):
     return [ (transform.TransformChain(),self) ]
 
+  @cache.property
+  def _ischemes( self ):
+    return {}
+
   def getischeme( self, ischeme ):
+    '''Points and weights of integration scheme. Results are memoized and
+    returned as read-only arrays, such that shape functions can be tabulated
+    on them by StdElem.tabulate.'''
+
+    try:
+      return self._ischemes[ischeme]
+    except KeyError:
+      pass
+    points, weights = self._getischeme( ischeme )
+    for array in points, weights:
+      if isinstance( array, numpy.ndarray ):
+        array.flags.writeable = False
+    self._ischemes[ischeme] = points, weights
+    return points, weights
+
+  def _getischeme( self, ischeme ):
     if self.ndims == 0:
       return numpy.zeros([1,0]), numpy.array([1.])
     match = re.match( '([a-zA-Z]+)(.*)', ischeme )
@@ -595,7 +615,7 @@ class TensorReference( Reference ):
     z = numpy.zeros_like( p )
     return numpy.hstack(( [p,z], [1-z,p], [1-p,1-z], [z,1-p] )).T, None
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     match = re.match( '([a-zA-Z]+)(.*)', ischeme )
     assert match, 'cannot parse integration scheme %r' % ischeme
     ptype, args = match.groups()
@@ -784,7 +804,7 @@ class MosaicReference( Reference ):
     vertices = numpy.zeros( (0,ndims), dtype=int )
     Reference.__init__( self, vertices )
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     'get integration scheme'
     
     assert not ischeme.startswith('vertex')
@@ -809,9 +829,40 @@ class MosaicReference( Reference ):
 
 # SHAPE FUNCTIONS
 
+_tables = {}
+_tableslock = threading.Lock()
+
+def _tabulate( std, points, grad=0 ):
+  '''Evaluate std on points, memoizing the result for as long as the points
+  array exists. Points are compared by identity, which makes this effective
+  for memoized integration schemes; as this is only safe for points that
+  cannot change, writeable arrays are evaluated without memoization. The
+  table is guarded by a lock such that it can be shared by threads.'''
+
+  if not isinstance( points, numpy.ndarray ) or points.flags.writeable:
+    return std.eval( points, grad )
+  key = std, id(points), grad
+  with _tableslock:
+    try:
+      return _tables[key][0]
+    except KeyError:
+      pass
+  values = std.eval( points, grad )
+  if isinstance( values, numpy.ndarray ):
+    values.flags.writeable = False
+  try:
+    ref = weakref.ref( points, lambda ref: _tables.pop( key, None ) )
+  except TypeError:
+    return values # not weakly referenceable
+  with _tableslock:
+    _tables[key] = values, ref
+  return values
+
 class StdElem( cache.Immutable ):
   'stdelem base class'
 
+  tabulate = _tabulate
+
   def __init__( self, ndims, nshapes ):
     self.ndims = ndims
     self.nshapes = nshapes
@@ -1101,6 +1152,8 @@ class ExtractionWrapper( object ):
 
   __slots__ = 'stdelem', 'extraction'
 
+  tabulate = _tabulate
+
   def __init__( self, stdelem, extraction ):
     'constructor'
 
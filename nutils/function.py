@@ -30,13 +30,14 @@ expensive and currently unsupported operation.
 
 from __future__ import print_function, division
 from . import util, numpy, numeric, log, core, cache, transform, rational, _
-import sys, warnings
+import sys, warnings, time
 
 CACHE = 'Cache'
 TRANS = 'Trans'
 POINTS = 'Points'
+ARGS = 'Args'
 
-TOKENS = CACHE, TRANS, POINTS
+TOKENS = CACHE, TRANS, POINTS, ARGS
 
 class Evaluable( cache.Immutable ):
   'Base class'
@@ -52,31 +53,42 @@ class Evaluable( cache.Immutable ):
 
   @cache.property
   def serialized( self ):
-    '''returns (ops,inds), where len(ops) = len(inds)-1'''
+    '''returns (ops,inds), where len(ops) = len(inds)-1; ops are ordered such
+    that every operation follows its arguments, with self implied last'''
+
+    ops = []
+    inds = []
+    index = {} # id(op) -> slot
+    stack = [ ( self, iter(self.__args) ) ]
+    while stack:
+      op, args = stack[-1]
+      for arg in args:
+        if isinstance( arg, Evaluable ) and id(arg) not in index:
+          stack.append( ( arg, iter(arg.__args) ) )
+          break
+      else:
+        stack.pop()
+        index[id(op)] = len(TOKENS) + len(ops)
+        ops.append( op )
+        inds.append( tuple( index[id(arg)] if isinstance( arg, Evaluable ) else TOKENS.index(arg) for arg in op.__args ) )
+    assert ops.pop() is self
+    return tuple(ops), tuple(inds)
 
-    myops = list( TOKENS )
-    myinds = []
-    indices = []
-    for arg in self.__args:
-      try:
-        index = myops.index( arg )
-      except ValueError:
-        argops, arginds = arg.serialized
-        renumber = list( range( len(TOKENS) ) )
-        for op, ind in zip( argops, arginds ):
-          try:
-            n = myops.index( op )
-          except ValueError:
-            n = len(myops)
-            myops.append( op )
-            myinds.append( numpy.take(renumber,ind) )
-          renumber.append( n )
-        index = len(myops)
-        myops.append( arg )
-        myinds.append( numpy.take(renumber,arginds[-1]) )
-      indices.append( index )
-    myinds.append( indices )
-    return tuple(myops[len(TOKENS):]), tuple(myinds)
+  @cache.property
+  def graphstats( self ):
+    '''returns dictionary with the number of operations (nops), the length of
+    the longest path from a token to self (depth) and the number of operations
+    per class (classes), for profiling purposes'''
+
+    ops, inds = self.serialized
+    depths = [ 0 ] * len(TOKENS)
+    classes = {}
+    for op in ops + (self,):
+      name = op.__class__.__name__
+      classes[name] = classes.get( name, 0 ) + 1
+    for indices in inds:
+      depths.append( 1 + int( numpy.max( [ 0 ] + [ depths[i] for i in indices ] ) ) )
+    return dict( nops=len(ops)+1, depth=depths[-1], classes=classes )
 
   def asciitree( self ):
     'string representation'
@@ -94,9 +106,9 @@ class Evaluable( cache.Immutable ):
   def __str__( self ):
     return self.__class__.__name__
 
-  def eval( self, elem, ischeme, fcache=lambda f, *args: f(*args) ):
-    'evaluate'
-    
+  def _elempoints( self, elem, ischeme, fcache ):
+    'parse element and integration scheme into transform pair and points'
+
     if isinstance( elem, tuple ):
       assert isinstance( ischeme, numpy.ndarray )
       points = ischeme
@@ -125,28 +137,129 @@ class Evaluable( cache.Immutable ):
     if points is not None:
       assert points.ndim == 2 and points.shape[1] == trans[0].fromdims
 
-    ops, inds = self.serialized
-    assert TOKENS == ( CACHE, TRANS, POINTS )
-    values = [ fcache, trans, points ]
-    for op, indices in zip( list(ops)+[self], inds ):
-      args = [ values[i] for i in indices ]
+    return trans, points
+
+  @cache.property
+  def plan( self ):
+    'compiled evaluation plan'
+
+    return EvaluationPlan( self )
+
+  @cache.property
+  def optimizedplan( self ):
+    'compiled evaluation plan with common subexpressions eliminated'
+
+    return EvaluationPlan( self, optimize=True )
+
+  def eval( self, elem, ischeme, fcache=lambda f, *args: f(*args), optimize=False, elemcache=None, arguments=None ):
+    'evaluate, with arguments a dictionary of values of Argument placeholders by name'
+    
+    trans, points = self._elempoints( elem, ischeme, fcache )
+    plan = self.optimizedplan if optimize else self.plan
+    return plan( fcache, trans, points, elemcache, arguments )
+
+  def eval_batch( self, elems, ischeme, fcache=lambda f, *args: f(*args), optimize=False, elemcache=None, arguments=None ):
+    '''Evaluate for a sequence of elements, returning the list of values that
+    repeated calls to eval would produce. Array operations that do not depend
+    on the element transformation are evaluated only once, on the
+    concatenation of all point sets, which reduces interpreter overhead for
+    elements sharing a reference and integration scheme. Operations that
+    depend on the transformation, or that produce per-element data such as
+    dof indices, are evaluated element by element, or taken from elemcache
+    as in EvaluationPlan.'''
+
+    if len(elems) == 1:
+      return [ self.eval( elems[0], ischeme, fcache, optimize, elemcache, arguments ) ]
+
+    trans, points = zip( *[ self._elempoints( elem, ischeme, fcache ) for elem in elems ] )
+    if any( p is None for p in points ):
+      return [ self.eval( elem, ischeme, fcache, optimize, elemcache, arguments ) for elem in elems ]
+
+    nelems = len(elems)
+    offsets = numpy.cumsum( [0] + [ len(p) for p in points ] )
+    npoints = offsets[-1]
+
+    # Every value is held in per-element form (a list of nelems values), in
+    # batched form (a single array with leading axis of length npoints, or 1
+    # if constant), or both. Conversion happens lazily, and a per-element
+    # value is marked unbatchable if its shapes do not line up.
+
+    plan = self.optimizedplan if optimize else self.plan
+    profile = core.getprop( 'evalprofile', None )
+    evalfs = plan.evalfs if profile is None else profile.evalfs( plan.ops )
+    perelem = [ [fcache]*nelems, list(trans), list(points), [arguments]*nelems ]
+    batched = [ None, None, numpy.concatenate( points, axis=0 ), None ]
+    batchable = [ False, False, True, False ]
+
+    def getbatched( i ):
+      if batched[i] is None and batchable[i]:
+        values = perelem[i]
+        shape = values[0].shape[1:]
+        if all( isinstance( v, numpy.ndarray ) and v.shape[1:] == shape and len(v) in ( 1, n1-n0 )
+            for v, n0, n1 in zip( values, offsets[:-1], offsets[1:] ) ):
+          retval = numpy.empty( (npoints,)+shape, dtype=numpy.result_type( *values ) )
+          for v, n0, n1 in zip( values, offsets[:-1], offsets[1:] ):
+            retval[n0:n1] = v
+          batched[i] = retval
+        else:
+          batchable[i] = False
+      return batched[i]
+
+    def getperelem( i ):
+      if perelem[i] is None:
+        arr = batched[i]
+        perelem[i] = [ arr ] * nelems if len(arr) == 1 \
+          else [ arr[n0:n1] for n0, n1 in zip( offsets[:-1], offsets[1:] ) ]
+      return perelem[i]
+
+    start = 0
+    if elemcache is not None:
+      elemvalues = [ [ fcache, t, p, arguments ] + [ None ] * len(plan.ops) for t, p in zip( trans, points ) ]
       try:
-        retval = op.evalf( *args )
+        for values in elemvalues:
+          for i in plan.frontier:
+            plan._fetch( i, values, elemcache, evalfs )
       except KeyboardInterrupt:
         raise
       except:
-        etype, evalue, traceback = sys.exc_info()
-        excargs = etype, evalue, self, values
-        try: # python2/3
-          exec( 'raise EvaluationError, excargs, traceback' )
-        except SyntaxError:
-          raise EvaluationError(*excargs).with_traceback( traceback )
-      values.append( retval )
-    return values[-1]
+        _reraise( plan, values[:len(TOKENS)+plan.nelemops] )
+      start = plan.nelemops
+      for i, op in enumerate( plan.ops[:start], start=len(TOKENS) ):
+        perelem.append( [ values[i] for values in elemvalues ] if i in plan.frontier else None )
+        batched.append( None )
+        batchable.append( isinstance( op, ArrayFunc ) )
+
+    for iop in range( start, len(plan.ops) ):
+      op = plan.ops[iop]
+      indices = plan.args[iop]
+      try:
+        retval = None
+        if isinstance( op, ArrayFunc ) and plan.kinds[iop] != plan.ELEMENT and CACHE not in op.__args and TRANS not in op.__args:
+          args = [ getbatched(i) for i in indices ]
+          if all( arg is not None for arg in args ):
+            retval = evalfs[iop]( *args )
+            if not isinstance( retval, numpy.ndarray ) or retval.ndim != op.ndim+1 or len(retval) not in ( 1, npoints ):
+              retval = None
+        if retval is not None:
+          perelem.append( None )
+          batched.append( retval )
+          batchable.append( True )
+        else:
+          args = zip( *[ getperelem(i) for i in indices ] ) if indices else [()] * nelems
+          perelem.append( [ evalfs[iop]( *elemargs ) for elemargs in args ] )
+          batched.append( None )
+          batchable.append( isinstance( op, ArrayFunc ) )
+      except KeyboardInterrupt:
+        raise
+      except:
+        _reraise( plan, batched )
+      for i in plan.release[iop]:
+        perelem[i] = batched[i] = None
+    return getperelem( -1 )
 
   @log.title
-  def graphviz( self ):
-    'create function graph'
+  def graphviz( self, profile=None ):
+    'create function graph, with nodes shaded by time spent if profile is given'
 
     import os, subprocess
 
@@ -160,44 +273,419 @@ class Evaluable( cache.Immutable ):
     ops, inds = self.serialized
 
     try:
-      dot = subprocess.Popen( [dotpath,'-T'+imgtype], stdin=subprocess.PIPE, stdout=open(imgpath,'w') )
+      dot = subprocess.Popen( [dotpath,'-T'+imgtype], stdin=subprocess.PIPE, stdout=open(imgpath,'w'), universal_newlines=True )
     except OSError:
       log.error( 'error: failed to execute', dotpath )
       return False
 
-    print >> dot.stdin, 'digraph {'
-    print >> dot.stdin, 'graph [ dpi=72 ];'
-    dot.stdin.writelines( '%d [label="%d. %s"];\n' % (i,i,name)
-      for i, name in enumerate( TOKENS + ops + (self,) ) )
+    def node( i, op ):
+      if profile is None or not profile.calls.get( op ):
+        return '%d [label="%d. %s"];\n' % (i,i,op)
+      shade = 1 + int( 8 * profile.fraction( op ) )
+      return '%d [label="%d. %s\\n%s", style=filled, fillcolor="/reds9/%d"];\n' % (i,i,op,profile.summary(op),shade)
+
+    dot.stdin.write( 'digraph {\n' )
+    dot.stdin.write( 'graph [ dpi=72 ];\n' )
+    dot.stdin.writelines( node( i, op )
+      for i, op in enumerate( TOKENS + ops + (self,) ) )
     dot.stdin.writelines( '%d -> %d;\n' % (j,i)
       for i, indices in enumerate( ([],)*len(TOKENS) + inds )
         for j in indices )
-    print >> dot.stdin, '}'
+    dot.stdin.write( '}\n' )
     dot.stdin.close()
 
     log.path( os.path.basename(imgpath) )
 
-  def stackstr( self, nlines=-1 ):
-    'print stack'
+  def stackstr( self, nlines=-1, profile=None ):
+    'print stack, annotated with timings if profile is given'
 
     ops, inds = self.serialized
-    lines = []
-    for name in TOKENS:
-      lines.append( '  %%%d = %s' % ( len(lines), name ) )
-    for op, indices in zip( list(ops)+[self], inds ):
-      args = [ '%%%d' % idx for idx in indices ]
+    return _stackstr( list(ops)+[self], inds, nlines, profile )
+
+def _stackstr( ops, inds, nlines=-1, profile=None ):
+  'print stack of serialized operations'
+
+  lines = []
+  for name in TOKENS:
+    lines.append( '  %%%d = %s' % ( len(lines), name ) )
+  for op, indices in zip( ops, inds ):
+    args = [ '%%%d' % idx for idx in indices ]
+    try:
+      code = op.evalf.__code__
+      offset = 1 if getattr( op.evalf, '__self__', None ) is not None else 0
+      names = code.co_varnames[ offset:code.co_argcount ]
+      names += tuple( '%s[%d]' % ( code.co_varnames[ code.co_argcount ], n ) for n in range( len(indices) - len(names) ) )
+      args = [ '%s=%s' % item for item in zip( names, args ) ]
+    except:
+      pass
+    lines.append( '  %%%d = %s( %s )' % ( len(lines), op, ', '.join( args ) ) )
+    if profile is not None and profile.calls.get( op ):
+      lines[-1] += '  # %s' % profile.summary( op )
+    if len(lines) == nlines+1:
+      break
+  return '\n'.join( lines )
+
+class EvaluationPlan( object ):
+  '''Compiled form of a serialized evaluable. The plan holds the bound evalf
+  methods of all operations, their argument slots as index tuples, and for
+  every operation the slots whose last consumer it is, such that
+  intermediate values are dropped as soon as they are no longer needed. If
+  optimize is True the operations are passed through _optimize first.
+
+  Every operation is classified as CONSTANT, ELEMENT (depending on the
+  transformation but not on the points) or POINTWISE, and the first nelemops
+  operations are the non-pointwise ones. The frontier lists their slots that
+  are consumed by pointwise operations or form the result. If an elemcache
+  is passed on evaluation, a weak key dictionary mapping operations onto
+  dictionaries of values by transformation (None for constants), frontier
+  values are taken from it, and missing values are computed and stored.
+  Since operations such as Iwscale, Transform or DofMap are shared between
+  evaluables, the cache serves any evaluable on the same mesh.'''
+
+  CONSTANT, ELEMENT, POINTWISE = range(3)
+
+  def __init__( self, evaluable, optimize=False ):
+    'constructor'
+
+    ops, inds = evaluable.serialized
+    ops = list(ops) + [ evaluable ]
+    args = [ tuple( int(i) for i in indices ) for indices in inds ]
+    if optimize:
+      nops = len(ops)
+      ops, args, nhoisted = _optimize( ops, args )
+      log.debug( 'optimized evaluation plan: removed %d of %d operations, hoisted %d element constants' % ( nops-len(ops), nops, nhoisted ) )
+
+    assert TOKENS == ( CACHE, TRANS, POINTS, ARGS )
+    kinds = [ self.CONSTANT, self.ELEMENT, self.POINTWISE, self.POINTWISE ] # arguments vary between calls
+    for indices in args:
+      kinds.append( int( numpy.max( [ self.CONSTANT ] + [ kinds[i] for i in indices ] ) ) )
+    order = [ iop for iop in range( len(ops) ) if kinds[len(TOKENS)+iop] != self.POINTWISE ]
+    self.nelemops = len(order)
+    order += [ iop for iop in range( len(ops) ) if kinds[len(TOKENS)+iop] == self.POINTWISE ]
+    renumber = numpy.empty( len(TOKENS)+len(ops), dtype=int )
+    renumber[:len(TOKENS)] = numpy.arange( len(TOKENS) )
+    renumber[ len(TOKENS) + numpy.array( order, dtype=int ) ] = numpy.arange( len(TOKENS), len(TOKENS)+len(ops) )
+
+    self.ops = tuple( ops[iop] for iop in order )
+    self.evalfs = tuple( op.evalf for op in self.ops )
+    self.args = tuple( tuple( int(renumber[i]) for i in args[iop] ) for iop in order )
+    self.kinds = tuple( kinds[len(TOKENS)+iop] for iop in order )
+    self.nslots = len(TOKENS) + len(self.ops)
+    lastuse = {}
+    for iop, args in enumerate( self.args ):
+      for i in args:
+        lastuse[i] = iop
+    release = [ [] for op in self.ops ]
+    for i, iop in lastuse.items():
+      release[iop].append( i )
+    self.release = tuple( tuple(sorted(r)) for r in release )
+    frontier = set( i for args in self.args[self.nelemops:] for i in args if len(TOKENS) <= i < len(TOKENS)+self.nelemops )
+    if self.nelemops == len(self.ops):
+      frontier.add( self.nslots-1 )
+    self.frontier = tuple( sorted( frontier ) )
+    self.evaluable = evaluable
+
+  def __call__( self, fcache, trans, points, elemcache=None, arguments=None ):
+    'evaluate'
+
+    profile = core.getprop( 'evalprofile', None )
+    evalfs = self.evalfs if profile is None else profile.evalfs( self.ops )
+    values = [ None ] * self.nslots
+    values[:len(TOKENS)] = fcache, trans, points, arguments
+    start = 0
+    if elemcache is not None:
       try:
-        code = op.evalf.__code__
-        offset = 1 if getattr( op.evalf, '__self__', None ) is not None else 0
-        names = code.co_varnames[ offset:code.co_argcount ]
-        names += tuple( '%s[%d]' % ( code.co_varnames[ code.co_argcount ], n ) for n in range( len(indices) - len(names) ) )
-        args = [ '%s=%s' % item for item in zip( names, args ) ]
+        for i in self.frontier:
+          self._fetch( i, values, elemcache, evalfs )
+      except KeyboardInterrupt:
+        raise
       except:
-        pass
-      lines.append( '  %%%d = %s( %s )' % ( len(lines), op, ', '.join( args ) ) )
-      if len(lines) == nlines+1:
-        break
-    return '\n'.join( lines )
+        _reraise( self, values[:len(TOKENS)+self.nelemops] )
+      start = self.nelemops
+    islot = len(TOKENS) + start
+    try:
+      for evalf, args, release in zip( evalfs[start:], self.args[start:], self.release[start:] ):
+        values[islot] = evalf( *[ values[i] for i in args ] )
+        for i in release:
+          values[i] = None
+        islot += 1
+    except KeyboardInterrupt:
+      raise
+    except:
+      _reraise( self, values[:islot] )
+    return values[-1]
+
+  def _fetch( self, islot, values, elemcache, evalfs=None ):
+    'get constant or element value from elemcache, or evaluate and store it'
+
+    if evalfs is None:
+      evalfs = self.evalfs
+    value = values[islot]
+    if value is None and islot >= len(TOKENS):
+      iop = islot - len(TOKENS)
+      op = self.ops[iop]
+      key = values[1] if self.kinds[iop] == self.ELEMENT else None
+      try:
+        value = elemcache[op,key]
+      except KeyError:
+        value = evalfs[iop]( *[ self._fetch( i, values, elemcache, evalfs ) for i in self.args[iop] ] )
+        elemcache[op,key] = value
+      values[islot] = value
+    return value
+
+  def __len__( self ):
+    return len( self.ops )
+
+  def stackstr( self, nlines=-1, profile=None ):
+    'print stack, annotated with timings if profile is given'
+
+    return _stackstr( self.ops, self.args, nlines, profile )
+
+class Profile( object ):
+  '''Accumulator of wall time, number of calls and output bytes per
+  operation, filled by all evaluations of which the caller holds the
+  property __evalprofile__:
+
+  >>> __evalprofile__ = profile = function.Profile()
+  >>> domain.integrate( func, geometry=geom, ischeme='gauss2' )
+  >>> profile.log()
+
+  Batched evaluations count as a single call. Only evaluations in the current
+  process are seen, so profiling is meant for runs with __nprocs__ = 1.'''
+
+  def __init__( self ):
+    'constructor'
+
+    self.times = {}
+    self.calls = {}
+    self.nbytes = {}
+    self._evalfs = {}
+
+  def evalfs( self, ops ):
+    'instrumented evalf methods of ops'
+
+    try:
+      return tuple( self._evalfs[op] for op in ops )
+    except KeyError:
+      pass
+    for op in ops:
+      if op not in self._evalfs:
+        self._evalfs[op] = self._instrument( op )
+    return tuple( self._evalfs[op] for op in ops )
+
+  def _instrument( self, op ):
+    'wrap op.evalf to record timings'
+
+    evalf = op.evalf
+    self.times[op] = 0.
+    self.calls[op] = 0
+    self.nbytes[op] = 0
+    def profiled( *args ):
+      t0 = time.time()
+      retval = evalf( *args )
+      self.times[op] += time.time() - t0
+      self.calls[op] += 1
+      self.nbytes[op] += cache._nbytes( retval )
+      return retval
+    return profiled
+
+  @property
+  def total( self ):
+    'total time spent in all operations'
+
+    return util.sum( self.times.values() ) if self.times else 0.
+
+  def fraction( self, op ):
+    'fraction of total time spent in op'
+
+    total = self.total
+    return self.times[op] / total if total else 0.
+
+  def summary( self, op ):
+    'one line summary of the timings of op'
+
+    return '%.1fms %.0f%% %dx %s' % ( self.times[op]*1e3, self.fraction(op)*100, self.calls[op], _bytes2str( self.nbytes[op] ) )
+
+  def byclass( self ):
+    'dictionary of (time,calls,nbytes) per operation class name'
+
+    classes = {}
+    for op in self.calls:
+      name = op.__class__.__name__
+      t, n, b = classes.get( name, ( 0., 0, 0 ) )
+      classes[name] = t + self.times[op], n + self.calls[op], b + self.nbytes[op]
+    return classes
+
+  def log( self, nrows=10 ):
+    'log tables of the most expensive operation classes and nodes'
+
+    total = self.total
+    log.info( '%d operations, %.3fs total' % ( len(self.calls), total ) )
+    classes = sorted( self.byclass().items(), key=lambda item: -item[1][0] )
+    log.info( '%-16s %10s %6s %10s %10s' % ( 'class', 'time [ms]', '%', 'calls', 'output' ) )
+    for name, ( t, n, b ) in classes[:nrows]:
+      log.info( '%-16s %10.1f %6.1f %10d %10s' % ( name, t*1e3, t/total*100 if total else 0, n, _bytes2str(b) ) )
+    ops = sorted( self.calls, key=lambda op: -self.times[op] )
+    log.info( '%-16s %10s %6s %10s %10s' % ( 'node', 'time [ms]', '%', 'calls', 'output' ) )
+    for op in ops[:nrows]:
+      log.info( '%-16s %10.1f %6.1f %10d %10s' % ( op, self.times[op]*1e3, self.fraction(op)*100, self.calls[op], _bytes2str(self.nbytes[op]) ) )
+
+def _bytes2str( nbytes ):
+  'human readable number of bytes'
+
+  for unit in 'B', 'KB', 'MB':
+    if nbytes < 1024:
+      return '%d%s' % ( nbytes, unit )
+    nbytes //= 1024
+  return '%dGB' % nbytes
+
+def _optimize( ops, args ):
+  '''Optimize serialized operations, the last of which is the root. Returns
+  new lists of operations and argument slots, and the number of hoisted
+  element constants. Operations that compute the same value are merged, which
+  catches duplicates that the constructors leave standing, such as
+  commutative operations whose operands were built separately. Nested and
+  identity alignments are collapsed, and in products of pointwise data with
+  element constants (as with Iwscale or Transform) the constants are
+  multiplied first, outside the point axis.'''
+
+  constructorargs = {} # filled by _merge for the operations of this graph only
+  ops, args = _merge( ops, args, constructorargs, _collapsealign )
+  nuses = {}
+  for indices in args:
+    for i in indices:
+      if i >= len(TOKENS):
+        op = ops[i-len(TOKENS)]
+        nuses[id(op)] = nuses.get( id(op), 0 ) + 1
+  hoisted = []
+  ops, args = _merge( ops, args, constructorargs, lambda *args: _hoistconstant( nuses, hoisted, *args ) )
+  return ops, args, len(hoisted)
+
+def _merge( ops, args, constructorargs, rewrite ):
+  '''Merge operations with equal class and constructor arguments, where
+  evaluable arguments are replaced by the representative of their class of
+  equal operations, and operands of commutative operations are unordered.
+  The rewrite function is called for every operation with its renumbered
+  argument slots, the lists of new operations and their argument slots, the
+  pointwise flags of all slots, and the emit function that appends an operation and returns its slot; if it
+  returns a slot the operation is replaced by it. Unused operations are
+  removed.'''
+
+  newops = []
+  newargs = []
+  pointwise = [ False, False, True, True ] # dependence on POINTS or ARGS per slot
+  known = {}
+  reps = {}
+
+  def canonical( obj ):
+    if isinstance( obj, Evaluable ):
+      return cache.HashableAny( reps.get( id(obj), obj ) )
+    if isinstance( obj, tuple ):
+      return tuple( canonical(o) for o in obj )
+    if isinstance( obj, frozenset ):
+      return frozenset( canonical(o) for o in obj )
+    return obj
+
+  def emit( op, opargs ):
+    try:
+      key = constructorargs[id(op)]
+    except KeyError:
+      try:
+        key = cache.findargs( op )
+      except ValueError:
+        key = op,
+      constructorargs[id(op)] = key
+    key = canonical( key )
+    if isinstance( op, (Add,Multiply,Dot) ):
+      key = frozenset( key[:2] ), key[2:]
+    key = type(op), key
+    try:
+      islot = known[key]
+    except KeyError:
+      islot = known[key] = len(TOKENS) + len(newops)
+      newops.append( op )
+      newargs.append( opargs )
+      pointwise.append( any( pointwise[i] for i in opargs ) )
+    reps[id(op)] = newops[islot-len(TOKENS)]
+    return islot
+
+  renumber = list( range( len(TOKENS) ) )
+  for op, opargs in zip( ops, args ):
+    opargs = tuple( renumber[i] for i in opargs )
+    islot = rewrite( op, opargs, newops, newargs, pointwise, emit )
+    if islot is None:
+      islot = emit( op, opargs )
+    elif islot >= len(TOKENS):
+      reps[id(op)] = newops[islot-len(TOKENS)]
+    renumber.append( islot )
+
+  # remove operations that the root no longer depends on
+  used = [ True ] * len(TOKENS) + [ False ] * len(newops)
+  used[renumber[-1]] = True
+  for islot in reversed( range( len(TOKENS), renumber[-1]+1 ) ):
+    if used[islot]:
+      for i in newargs[islot-len(TOKENS)]:
+        used[i] = True
+  renumber = numpy.cumsum( used ) - 1
+  keep = [ iop for iop, u in enumerate( used[len(TOKENS):] ) if u ]
+  return [ newops[iop] for iop in keep ], \
+    [ tuple( int(renumber[i]) for i in newargs[iop] ) for iop in keep ]
+
+def _collapsealign( op, opargs, newops, newargs, pointwise, emit ):
+  'replace identity alignments by their argument and merge nested alignments'
+
+  if not isinstance( op, Align ):
+    return None
+  islot, = opargs
+  if op.axes == tuple( range( op.ndim ) ):
+    return islot
+  inner = newops[islot-len(TOKENS)] if islot >= len(TOKENS) else None
+  if not isinstance( inner, Align ):
+    return None
+  align = Align( inner.func, [ op.axes[ax] for ax in inner.axes ], op.ndim )
+  return emit( align, newargs[islot-len(TOKENS)] )
+
+def _hoistconstant( nuses, hoisted, op, opargs, newops, newargs, pointwise, emit ):
+  '''rewrite ( p * c1 ) * c2 as p * ( c1 * c2 ) for pointwise p and element
+  constants c1, c2 if the inner product has no other consumers'''
+
+  if not isinstance( op, Multiply ):
+    return None
+  factors = list( zip( op.funcs, opargs + (None,) ) ) # pairs of function, slot
+  for iinner in range( len(opargs) ):
+    islot = opargs[iinner]
+    inner = newops[islot-len(TOKENS)] if islot >= len(TOKENS) else None
+    if isinstance( inner, Multiply ) and pointwise[islot] and nuses.get( id(inner) ) == 1:
+      break
+  else:
+    return None
+  func2, slot2 = factors[1-iinner]
+  innerfactors = list( zip( inner.funcs, newargs[islot-len(TOKENS)] + (None,) ) )
+  ipoint = [ i for i, ( func, slot ) in enumerate( innerfactors ) if slot is not None and pointwise[slot] ]
+  if len(ipoint) != 1 or slot2 is not None and pointwise[slot2]:
+    return None
+  funcp, slotp = innerfactors[ipoint[0]]
+  func1, slot1 = innerfactors[1-ipoint[0]]
+  if slot1 is None and slot2 is None:
+    return None
+  slots = { id(func1): slot1, id(func2): slot2 }
+  const = Multiply( *_sorted( func1, func2 ) )
+  islot = emit( const, tuple( slots[id(func)] for func in const.funcs if isinstance( func, Evaluable ) ) )
+  slots = { id(funcp): slotp, id(const): islot }
+  product = Multiply( *_sorted( funcp, const ) )
+  nuses[id(product)] = nuses.get( id(op) )
+  hoisted.append( const )
+  return emit( product, tuple( slots[id(func)] for func in product.funcs ) )
+
+def _reraise( evaluable, values ):
+  'raise active exception as EvaluationError, preserving traceback'
+
+  etype, evalue, traceback = sys.exc_info()
+  excargs = etype, evalue, evaluable, values
+  try: # python2/3
+    exec( 'raise EvaluationError, excargs, traceback' )
+  except SyntaxError:
+    raise EvaluationError(*excargs).with_traceback( traceback )
 
 class EvaluationError( Exception ):
   'evaluation error'
@@ -381,7 +869,8 @@ class ArrayFunc( Evaluable ):
   def dot( self, weights, axis=0 ):
     'array contraction'
 
-    weights = numpy.asarray( weights, dtype=float )
+    if not _isfunc( weights ):
+      weights = numpy.asarray( weights, dtype=float )
     assert weights.ndim == 1
     s = [ numpy.newaxis ] * self.ndim
     s[axis] = slice(None)
@@ -581,7 +1070,7 @@ class ElemSign( ArrayFunc ):
   def _opposite( self ):
     return ElemSign( self.ndims, 1-self.side )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     return _zeros( (ndims,) )
 
 class Align( ArrayFunc ):
@@ -637,8 +1126,8 @@ class Align( ArrayFunc ):
     trans = [ ax - (ax>axis) for ax in self.axes if ax != axis ]
     return align( func, trans, self.ndim-1 )
 
-  def _localgradient( self, ndims ):
-    return align( localgradient( self.func, ndims ), self.axes+(self.ndim,), self.ndim+1 )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return align( localgradient( self.func, ndims, leafgrad ), self.axes+(self.ndim,), self.ndim+1 )
 
   def _multiply( self, other ):
     if not _isfunc(other) and len(self.axes) == other.ndim:
@@ -678,8 +1167,8 @@ class Get( ArrayFunc ):
     assert arr.ndim == self.ndim+2
     return arr[ self.item_shiftright ]
 
-  def _localgradient( self, ndims ):
-    f = localgradient( self.func, ndims )
+  def _localgradient( self, ndims, leafgrad=None ):
+    f = localgradient( self.func, ndims, leafgrad )
     return get( f, self.axis, self.item )
 
   def _get( self, i, item ):
@@ -710,8 +1199,8 @@ class Product( ArrayFunc ):
     assert arr.ndim == self.ndim+2
     return numpy.product( arr, axis=self.axis_shiftright )
 
-  def _localgradient( self, ndims ):
-    return self[...,_] * ( localgradient(self.func,ndims) / self.func[...,_] ).sum( self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return self[...,_] * ( localgradient( self.func, ndims, leafgrad ) / self.func[...,_] ).sum( self.axis )
 
   def _get( self, i, item ):
     func = get( self.func, i+(i>=self.axis), item )
@@ -758,7 +1247,7 @@ class Transform( ArrayFunc ):
     assert matrix.ndim == 2
     return matrix.astype( float )[_]
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     return _zeros( self.shape + (ndims,) )
 
   def _opposite( self ):
@@ -784,7 +1273,7 @@ class Function( ArrayFunc ):
     for std, keep in self.stdmap[head]:
       if std:
         transpoints = cache( trans[len(head):].apply, points )
-        F = cache( std.eval, transpoints, self.igrad )
+        F = std.tabulate( transpoints, self.igrad )
         assert F.ndim == self.igrad+2
         if keep is not None:
           F = F[(Ellipsis,keep)+(slice(None),)*self.igrad]
@@ -802,7 +1291,7 @@ class Function( ArrayFunc ):
   def _opposite( self ):
     return Function( self.ndims, self.stdmap, self.igrad, self.shape[0], 1-self.side )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     grad = Function( self.ndims, self.stdmap, self.igrad+1, self.shape[0], self.side )
     return grad if ndims == self.ndims \
       else dot( grad[...,_], Transform( self.ndims, ndims, self.side ), axes=-2 )
@@ -829,8 +1318,8 @@ class Choose( ArrayFunc ):
     assert all( choice.ndim == self.ndim+1 for choice in choices )
     return numpy.choose( level, choices )
 
-  def _localgradient( self, ndims ):
-    grads = [ localgradient( choice, ndims ) for choice in self.choices ]
+  def _localgradient( self, ndims, leafgrad=None ):
+    grads = [ localgradient( choice, ndims, leafgrad ) for choice in self.choices ]
     if not any( grads ): # all-zero special case; better would be allow merging of intervals
       return _zeros( self.shape + (ndims,) )
     return Choose( self.level[...,_], grads )
@@ -873,8 +1362,8 @@ class Inverse( ArrayFunc ):
     assert arr.ndim == self.ndim+1
     return numpy.linalg.inv( arr )
 
-  def _localgradient( self, ndims ):
-    G = localgradient( self.func, ndims )
+  def _localgradient( self, ndims, leafgrad=None ):
+    G = localgradient( self.func, ndims, leafgrad )
     H = sum( self[...,_,:,:,_]
               * G[...,:,:,_,:], -3 )
     I = sum( self[...,:,:,_,_]
@@ -947,8 +1436,8 @@ class Concatenate( ArrayFunc ):
     axis = self.axis - (self.axis > i)
     return concatenate( [ get( f, i, item ) for f in self.funcs ], axis=axis )
 
-  def _localgradient( self, ndims ):
-    funcs = [ localgradient( func, ndims ) for func in self.funcs ]
+  def _localgradient( self, ndims, leafgrad=None ):
+    funcs = [ localgradient( func, ndims, leafgrad ) for func in self.funcs ]
     return concatenate( funcs, axis=self.axis )
 
   def _multiply( self, other ):
@@ -1118,9 +1607,9 @@ class Cross( ArrayFunc ):
     assert a.ndim == b.ndim == self.ndim+1
     return numeric.cross( a, b, self.axis_shiftright )
 
-  def _localgradient( self, ndims ):
-    return cross( self.func1[...,_], localgradient(self.func2,ndims), axis=self.axis ) \
-         - cross( self.func2[...,_], localgradient(self.func1,ndims), axis=self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return cross( self.func1[...,_], localgradient( self.func2, ndims, leafgrad ), axis=self.axis ) \
+         - cross( self.func2[...,_], localgradient( self.func1, ndims, leafgrad ), axis=self.axis )
 
   def _take( self, index, axis ):
     if axis != self.axis:
@@ -1142,9 +1631,9 @@ class Determinant( ArrayFunc ):
     assert arr.ndim == self.ndim+3
     return numpy.linalg.det( arr )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     Finv = swapaxes( inverse( self.func ) )
-    G = localgradient( self.func, ndims )
+    G = localgradient( self.func, ndims, leafgrad )
     return self[...,_] * sum( Finv[...,_] * G, axes=[-3,-2] )
 
   def _opposite( self ):
@@ -1157,20 +1646,25 @@ class DofIndex( ArrayFunc ):
     'constructor'
 
     assert index.ndim >= 1
-    assert isinstance( array, numpy.ndarray )
+    assert isinstance( array, numpy.ndarray ) or _isfunc( array )
     self.array = array
     assert 0 <= iax < self.array.ndim
     self.iax = iax
     self.index = index
     shape = self.array.shape[:iax] + index.shape + self.array.shape[iax+1:]
-    ArrayFunc.__init__( self, args=[index], shape=shape )
+    ArrayFunc.__init__( self, args=[index,array] if _isfunc(array) else [index], shape=shape )
 
-  def evalf( self, index ):
+  def evalf( self, index, array=None ):
     'evaluate'
 
-    item = [ slice(None) ] * self.array.ndim
+    if array is None:
+      array = self.array
+    else:
+      assert len(array) == 1, 'array varies within the element'
+      array = array[0]
+    item = [ slice(None) ] * array.ndim
     item[self.iax] = index
-    return self.array[ tuple(item) ][_]
+    return array[ tuple(item) ][_]
 
   def _get( self, i, item ):
     if self.iax <= i < self.iax + self.index.ndim:
@@ -1179,24 +1673,53 @@ class DofIndex( ArrayFunc ):
     return take( get( self.array, i, item ), self.index, self.iax if i > self.iax else self.iax-1 )
 
   def _add( self, other ):
-    if isinstance( other, DofIndex ) and self.iax == other.iax and self.index == other.index:
+    if isinstance( other, DofIndex ) and self.iax == other.iax and self.index == other.index and not _isfunc( self.array ) and not _isfunc( other.array ):
       return take( self.array + other.array, self.index, self.iax )
 
   def _multiply( self, other ):
-    if not _isfunc(other) and other.ndim == 0:
+    if not _isfunc(other) and other.ndim == 0 and not _isfunc( self.array ):
       return take( self.array * other, self.index, self.iax )
 
-  def _localgradient( self, ndims ):
-    return _zeros( self.shape + (ndims,) )
+  def _localgradient( self, ndims, leafgrad=None ):
+    if not _isfunc( self.array ):
+      return _zeros( self.shape + (ndims,) )
+    return take( localgradient( self.array, ndims, leafgrad ), self.index, self.iax )
 
   def _concatenate( self, other, axis ):
-    if isinstance( other, DofIndex ) and self.iax == other.iax and self.index == other.index:
+    if isinstance( other, DofIndex ) and self.iax == other.iax and self.index == other.index and not _isfunc( self.array ) and not _isfunc( other.array ):
       array = numpy.concatenate( [ self.array, other.array ], axis )
       return take( array, self.index, self.iax )
 
   def _opposite( self ):
     return take( self.array, opposite(self.index), self.iax )
 
+class Argument( ArrayFunc ):
+  '''Placeholder for a coefficient vector, evaluating to the value that is
+  passed under its name in the arguments of eval or integrate. Since the
+  function graph does not hold the values, it is formed only once for
+  repeated evaluations with different coefficients, such as in Newton
+  iterations, and derivatives with respect to it are found by derivative.'''
+
+  def __init__( self, name, length ):
+    'constructor'
+
+    self.name = name
+    ArrayFunc.__init__( self, args=[ARGS], shape=(length,) )
+
+  def evalf( self, arguments ):
+    'evaluate'
+
+    assert arguments is not None and self.name in arguments, 'missing argument %r' % self.name
+    value = numpy.asarray( arguments[self.name], dtype=float )
+    assert value.shape == self.shape, 'argument %r has shape %s, expected %s' % ( self.name, value.shape, self.shape )
+    return value[_]
+
+  def _localgradient( self, ndims, leafgrad=None ):
+    return _zeros( self.shape + (ndims,) )
+
+  def __str__( self ):
+    return '%s<%s>' % ( self.name, self.shape[0] )
+
 class Multiply( ArrayFunc ):
   'multiply'
 
@@ -1255,10 +1778,10 @@ class Multiply( ArrayFunc ):
     if func2_other is not None:
       return multiply( func1, func2_other )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     func1, func2 = self.funcs
-    return func1[...,_] * localgradient( func2, ndims ) \
-         + func2[...,_] * localgradient( func1, ndims )
+    return func1[...,_] * localgradient( func2, ndims, leafgrad ) \
+         + func2[...,_] * localgradient( func1, ndims, leafgrad )
 
   def _takediag( self ):
     func1, func2 = self.funcs
@@ -1297,9 +1820,9 @@ class Add( ArrayFunc ):
   def _sum( self, axis ):
     return sum( self.funcs[0], axis ) + sum( self.funcs[1], axis )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     func1, func2 = self.funcs
-    return localgradient( func1, ndims ) + localgradient( func2, ndims )
+    return localgradient( func1, ndims, leafgrad ) + localgradient( func2, ndims, leafgrad )
 
   def _get( self, i, item ):
     func1, func2 = self.funcs
@@ -1391,10 +1914,10 @@ class Dot( ArrayFunc ):
     func1, func2 = self.funcs
     return dot( get( func1, i, item ), get( func2, i, item ), [ ax-1 for ax in self.axes ] )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     func1, func2 = self.funcs
-    return dot( localgradient( func1, ndims ), func2[...,_], self.axes ) \
-         + dot( func1[...,_], localgradient( func2, ndims ), self.axes )
+    return dot( localgradient( func1, ndims, leafgrad ), func2[...,_], self.axes ) \
+         + dot( func1[...,_], localgradient( func2, ndims, leafgrad ), self.axes )
 
   def _multiply( self, other ):
     func1, func2 = self.funcs
@@ -1465,8 +1988,8 @@ class Sum( ArrayFunc ):
     if trysum is not None:
       return sum( trysum, self.axis )
 
-  def _localgradient( self, ndims ):
-    return sum( localgradient( self.func, ndims ), self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return sum( localgradient( self.func, ndims, leafgrad ), self.axis )
 
   def _opposite( self ):
     return sum( opposite(self.func), axes=self.axis )
@@ -1492,8 +2015,8 @@ class Debug( ArrayFunc ):
 
     return '{DEBUG}'
 
-  def _localgradient( self, ndims ):
-    return Debug( localgradient( self.func, ndims ) )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return Debug( localgradient( self.func, ndims, leafgrad ) )
 
 class TakeDiag( ArrayFunc ):
   'extract diagonal'
@@ -1509,8 +2032,8 @@ class TakeDiag( ArrayFunc ):
     assert arr.ndim == self.ndim+2
     return numeric.takediag( arr )
 
-  def _localgradient( self, ndims ):
-    return swapaxes( takediag( localgradient( self.func, ndims ), -3, -2 ) )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return swapaxes( takediag( localgradient( self.func, ndims, leafgrad ), -3, -2 ) )
 
   def _sum( self, axis ):
     if axis != self.ndim-1:
@@ -1549,8 +2072,8 @@ class Take( ArrayFunc ):
     assert arr.ndim == self.ndim+1
     return arr[ self.item ]
 
-  def _localgradient( self, ndims ):
-    return take( localgradient( self.func, ndims ), self.indices, self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return take( localgradient( self.func, ndims, leafgrad ), self.indices, self.axis )
 
   def _opposite( self ):
     return take( opposite(self.func), self.indices, self.axis )
@@ -1585,13 +2108,13 @@ class Power( ArrayFunc ):
     return numpy.power( args[0] if self.varbase else self.func,
                         args[-1] if self.varexp else self.power )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     # self = func**power
     # ln self = power * ln func
     # self` / self = power` * ln func + power * func` / func
     # self` = power` * ln func * self + power * func` * func**(power-1)
-    return self.power * power( self.func, self.power-1 )[...,_] * localgradient( self.func, ndims ) \
-         + ( ln( self.func ) * self )[...,_] * localgradient( self.power, ndims )
+    return self.power * power( self.func, self.power-1 )[...,_] * localgradient( self.func, ndims, leafgrad ) \
+         + ( ln( self.func ) * self )[...,_] * localgradient( self.power, ndims, leafgrad )
 
   def _power( self, n ):
     func = self.func
@@ -1640,7 +2163,7 @@ class ElemFunc( ArrayFunc ):
 
     return trans.split(self.shape[0])[1].apply( points ).astype( float )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     return eye( ndims ) if self.shape[0] == ndims \
       else Transform( self.shape[0], ndims, self.side )
 
@@ -1669,8 +2192,8 @@ class Pointwise( ArrayFunc ):
     assert all( arr.ndim == self.ndim+1 for arr in args )
     return self.evalfun( *args )
 
-  def _localgradient( self, ndims ):
-    return ( self.deriv( self.args )[...,_] * localgradient( self.args, ndims ) ).sum( 0 )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return ( self.deriv( self.args )[...,_] * localgradient( self.args, ndims, leafgrad ) ).sum( 0 )
 
   def _takediag( self ):
     return pointwise( takediag(self.args), self.evalfun, self.deriv )
@@ -1699,7 +2222,7 @@ class Sign( ArrayFunc ):
     assert arr.ndim == self.ndim+1
     return numpy.sign( arr )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     return _zeros( self.shape + (ndims,) )
 
   def _takediag( self ):
@@ -1800,7 +2323,7 @@ class Zeros( ArrayFunc ):
     assert self.shape[axis] == 1
     return _zeros( self.shape[:axis] + (length,) + self.shape[axis+1:] )
 
-  def _localgradient( self, ndims ):
+  def _localgradient( self, ndims, leafgrad=None ):
     return _zeros( self.shape+(ndims,) )
 
   def _add( self, other ):
@@ -1888,8 +2411,8 @@ class Inflate( ArrayFunc ):
       return
     return inflate( inflate( self.func, dofmap, length, axis ), self.dofmap, self.length, self.axis )
 
-  def _localgradient( self, ndims ):
-    return inflate( localgradient(self.func,ndims), self.dofmap, self.length, self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return inflate( localgradient( self.func, ndims, leafgrad ), self.dofmap, self.length, self.axis )
 
   def _align( self, shuffle, ndims ):
     return inflate( align(self.func,shuffle,ndims), self.dofmap, self.length, shuffle[self.axis] )
@@ -1977,8 +2500,8 @@ class Diagonalize( ArrayFunc ):
     assert arr is None or arr.ndim == self.ndim
     return numeric.diagonalize( arr if arr is not None else self.func[_] )
 
-  def _localgradient( self, ndims ):
-    return swapaxes( diagonalize( swapaxes( localgradient( self.func, ndims ), (-2,-1) ) ), (-3,-1) )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return swapaxes( diagonalize( swapaxes( localgradient( self.func, ndims, leafgrad ), (-2,-1) ) ), (-3,-1) )
 
   def _get( self, i, item ):
     if i >= self.ndim-2:
@@ -2028,8 +2551,8 @@ class Repeat( ArrayFunc ):
     assert arr is None or arr.ndim == self.ndim+1
     return numeric.fastrepeat( arr if arr is not None else self.func[_], self.length, self.axis_shiftright )
 
-  def _localgradient( self, ndims ):
-    return aslength( localgradient( self.func, ndims ), self.length, self.axis )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return aslength( localgradient( self.func, ndims, leafgrad ), self.length, self.axis )
 
   def _get( self, axis, item ):
     if axis == self.axis:
@@ -2099,8 +2622,8 @@ class Guard( ArrayFunc ):
   def _opposite( self ):
     return Guard( opposite(self.fun) )
 
-  def _localgradient( self, ndims ):
-    return Guard( localgradient(self.fun,ndims) )
+  def _localgradient( self, ndims, leafgrad=None ):
+    return Guard( localgradient( self.fun, ndims, leafgrad ) )
 
 # AUXILIARY FUNCTIONS
 
@@ -2622,8 +3145,10 @@ def takediag( arg, ax1=-2, ax2=-1 ):
 
   return TakeDiag( arg )
 
-def localgradient( arg, ndims ):
-  'local derivative'
+def localgradient( arg, ndims, leafgrad=None ):
+  '''local derivative; if given, leafgrad(op) returns the derivative of op to
+  be used in place of its local gradient, or None to apply the chain rule as
+  usual, see derivative'''
 
   arg = asarray( arg )
   shape = arg.shape + (ndims,)
@@ -2631,8 +3156,12 @@ def localgradient( arg, ndims ):
   if not _isfunc( arg ):
     return _zeros( shape )
 
-  lgrad = arg._localgradient( ndims )
-  assert lgrad.shape == shape, 'bug in %s._localgradient' % arg
+  lgrad = leafgrad( arg ) if leafgrad else None
+  if lgrad is None:
+    if not hasattr( arg, '_localgradient' ):
+      raise NotImplementedError( 'cannot differentiate %s' % type(arg).__name__ )
+    lgrad = arg._localgradient( ndims, leafgrad ) if leafgrad else arg._localgradient( ndims )
+  assert lgrad.shape == shape, 'bug in derivative of %s' % arg
 
   return lgrad
 
@@ -2997,6 +3526,61 @@ def function( fmap, nmap, ndofs, ndims ):
   dofmap = DofMap( nmap, axis=axis )
   return Inflate( func, dofmap, length=ndofs, axis=0 )
 
+def renumber( basis, method='rcm' ):
+  '''Renumber the dofs of a basis as created by function, to reduce bandwidth
+  and fill-in of the matrices it forms. The dofs are ordered by reverse
+  Cuthill-McKee (rcm) or nested dissection (nd) of the graph of dofs that
+  share an element. Returns the renumbered basis and the permutation perm
+  such that renumbered[i] equals basis[perm[i]]; constraints map to the new
+  numbering as cons[perm], and solutions back as lhs[perm] = newlhs.'''
+
+  import scipy.sparse
+  assert isinstance( basis, Inflate ) and isinstance( basis.dofmap, DofMap ) and basis.axis == 0, 'not a basis'
+  dofmap = basis.dofmap
+  rows, cols = [], []
+  for dofs in dofmap.dofmap.values():
+    rows.append( numpy.repeat( dofs, len(dofs) ) )
+    cols.append( numpy.tile( dofs, len(dofs) ) )
+  rows = numpy.concatenate( rows ) + dofmap.offset
+  cols = numpy.concatenate( cols ) + dofmap.offset
+  graph = scipy.sparse.csr_matrix( ( numpy.ones(len(rows)), (rows,cols) ), shape=(basis.length,)*2 )
+  if method == 'rcm':
+    import scipy.sparse.csgraph
+    perm = scipy.sparse.csgraph.reverse_cuthill_mckee( graph, symmetric_mode=True )
+  elif method == 'nd':
+    perm = _nesteddissection( graph, numpy.arange(basis.length) )
+  else:
+    raise Exception( 'invalid renumbering method %r' % method )
+  perm = numpy.asarray( perm, dtype=int )
+  invperm = numpy.empty_like( perm )
+  invperm[perm] = numpy.arange( len(perm) )
+  nmap = { trans: invperm[dofs+dofmap.offset] for trans, dofs in dofmap.dofmap.items() }
+  renumbered = Inflate( basis.func, DofMap( nmap, axis=dofmap.shape[0], side=dofmap.side ), length=basis.length, axis=0 )
+  return renumbered, perm
+
+def _nesteddissection( graph, nodes, minsize=16 ):
+  '''Order nodes of a symmetric graph by recursive bisection: the nodes of the
+  middle level of a breadth first search from a pseudo-peripheral node form a
+  separator that is ordered after the two halves it separates.'''
+
+  import scipy.sparse.csgraph
+  if len(nodes) <= minsize:
+    return nodes
+  subgraph = graph[nodes][:,nodes]
+  start = 0
+  for i in range( 2 ): # move towards a pseudo-peripheral node
+    distance = scipy.sparse.csgraph.shortest_path( subgraph, unweighted=True, indices=start )
+    start = numpy.argmax( numpy.where( numpy.isinf(distance), -1, distance ) )
+  distance = scipy.sparse.csgraph.shortest_path( subgraph, unweighted=True, indices=start )
+  finite = ~numpy.isinf( distance )
+  middle = numpy.floor( numpy.max( distance[finite] ) / 2. )
+  if middle == 0: # no separator to be found
+    return nodes
+  separator = distance == middle
+  part1 = distance < middle
+  part2 = ~part1 & ~separator # including disconnected nodes
+  return numpy.concatenate([ _nesteddissection( graph, nodes[part1], minsize ), _nesteddissection( graph, nodes[part2], minsize ), nodes[separator] ])
+
 def take( arg, index, axis ):
   'take index'
 
@@ -3110,6 +3694,31 @@ def fdapprox( func, w, dofs, delta=1.e-5 ):
     dfunc_fd.append( (func( *x1 ) - func( *x0 ))/step )
   return dfunc_fd
 
+def derivative( func, target ):
+  '''Forward mode derivative of func with respect to the Argument target,
+  which enters func through dot products such as basis.dot(target). The
+  derivative axis is appended and is sparse, formed by inflation with the dof
+  maps of the bases, such that integration yields a sparse jacobian. The
+  chain rule is taken from the local gradient of every operation, where the
+  element transformation and basis functions, being independent of the
+  coefficients, are treated as constants.'''
+
+  if not isinstance( target, Argument ):
+    raise TypeError( 'derivative requires an Argument target, got %s' % type(target).__name__ )
+  length, = target.shape
+  zeroleaves = ElemFunc, ElemSign, Function, Transform, Iwscale, Pointdata, Interpolate
+
+  def coefficientgradient( arg ):
+    if isinstance( arg, DofIndex ) and arg.array is target:
+      unit = diagonalize( DofIndex( numpy.ones( length ), 0, arg.index ) )
+      return inflate( unit, arg.index, length, axis=1 )
+    if arg is target:
+      return numpy.eye( length )
+    if isinstance( arg, zeroleaves ):
+      return _zeros( arg.shape + (length,) )
+
+  return localgradient( func, length, coefficientgradient )
+
 def _unpack( funcsp ):
   for axes, func in funcsp.blocks:
     dofax = axes[0]
@@ -44,36 +44,6 @@ class Matrix( object ):
     x0, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
     return numpy.linalg.norm( (self.matvec(x)-b)[I] ) / numpy.linalg.norm( (self.matvec(x0)-b)[I] )
 
-  def clone( self ):
-    warnings.warn( 'warning: arrays are immutable; clone returns self for backwards compatibility', DeprecationWarning )
-    return self
-
-class ScipyMatrix( Matrix ):
-  '''matrix based on any of scipy's sparse matrices'''
-
-  def __init__( self, core ):
-    self.core = core
-    Matrix.__init__( self, core.shape )
-
-  matvec = lambda self, vec: self.core.dot( vec )
-  toarray = lambda self: self.core.toarray()
-  toscipy = lambda self: self.core
-  __add__ = lambda self, other: ScipyMatrix( self.core + other.toscipy() )
-  __sub__ = lambda self, other: ScipyMatrix( self.core - other.toscipy() )
-  __mul__ = lambda self, other: ScipyMatrix( self.core * other )
-  __rmul__ = __mul__
-  __div__ = lambda self, other: ScipyMatrix( self.core / other )
-  T = property( lambda self: ScipyMatrix( self.core.transpose() ) )
-
-  def rowsupp( self, tol=0 ):
-    'return row indices with nonzero/non-small entries'
-
-    supp = numpy.empty( self.shape[0], dtype=bool )
-    for irow in range( self.shape[0] ):
-      a, b = self.core.indptr[irow:irow+2]
-      supp[irow] = a != b and ( tol == 0 or numpy.any( numpy.abs( self.core.data[a:b] ) > tol ) )
-    return supp
-
   @log.title
   def solve( self, b=None, constrain=None, lconstrain=None, rconstrain=None, tol=0, x0=None, solver=None, symmetric=False, title='solving system', callback=None, precon='diag', **solverargs ):
     'solve'
@@ -84,21 +54,23 @@ class ScipyMatrix( Matrix ):
       b = numpy.zeros( self.shape[0] )
     else:
       b = numpy.asarray( b, dtype=float )
-      assert b.ndim == 1, 'right-hand-side has shape %s, expected a vector' % (b.shape,)
-      assert b.shape == self.shape[:1]
+      assert b.ndim in (1,2), 'right-hand-side has shape %s, expected a vector or matrix' % (b.shape,)
+      assert b.shape[0] == self.shape[0]
 
     x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
-    b = ( b - self.core.dot(x) )[I]
+    if b.ndim == 2:
+      assert tol == 0, 'multiple right-hand-sides require a direct solve (tol=0)'
+      x = numpy.repeat( x[:,numpy.newaxis], b.shape[1], axis=1 )
+    b = ( b - self.matvec(x) )[I]
 
     if tol == 0:
-      A = self.toarray()[ numpy.ix_(I,J) ]
-      x[J] = numpy.linalg.solve( A, b )
+      x[J] = self._factorize( I, J )( b )
       return x
 
     if I.all() and J.all():
-      matvec = self.core.dot
+      matvec = self.matvec
     else:
-      def matvec( v, _tmp=numpy.zeros(self.shape[1]), _dot=self.core.dot, _I=I, _J=J ):
+      def matvec( v, _tmp=numpy.zeros(self.shape[1]), _dot=self.matvec, _I=I, _J=J ):
         _tmp[_J] = v
         return _dot(_tmp)[_I]
 
@@ -130,25 +102,298 @@ class ScipyMatrix( Matrix ):
     assert info == 0, '%s solver failed with status %d' % ( solver, info )
     return x
 
+  def clone( self ):
+    warnings.warn( 'warning: arrays are immutable; clone returns self for backwards compatibility', DeprecationWarning )
+    return self
+
+class SparsityPattern( object ):
+  '''Sparsity pattern of a matrix, formed from the sorted array of distinct flat
+  indices of its nonzero entries. Matrices built from the same pattern share
+  its index arrays, which are therefore read-only: scipy operations that
+  change the structure of a matrix in place raise an error rather than corrupt
+  all others, and need to be applied to a copy. Derived structures such as
+  constrained submatrices and fill reducing orderings are kept in the pattern
+  for reuse.'''
+
+  def __init__( self, index, shape ):
+    'constructor'
+
+    import scipy.sparse
+    assert len(shape) == 2
+    self.index = index
+    self.shape = tuple(shape)
+    rows, cols = divmod( index, shape[1] )
+    indptr = numpy.searchsorted( rows, numpy.arange( shape[0]+1 ) )
+    csr = scipy.sparse.csr_matrix( (numpy.zeros(len(index)),cols,indptr), shape )
+    self.indices = csr.indices
+    self.indptr = csr.indptr
+    for array in self.index, self.indices, self.indptr:
+      array.flags.writeable = False
+    self.cache = {}
+
+  def __len__( self ):
+    return len( self.index )
+
+  @property
+  def nbytes( self ):
+    'bytes held by the index arrays'
+
+    return self.index.nbytes + self.indices.nbytes + self.indptr.nbytes
+
+  def tocsr( self, data ):
+    'csr matrix with given data, sharing the index arrays of the pattern'
+
+    import scipy.sparse
+    assert data.shape == self.index.shape
+    csr = scipy.sparse.csr_matrix( (data,self.indices,self.indptr), self.shape, copy=False )
+    csr.has_sorted_indices = True
+    return csr
+
+  def submatrix( self, I, J ):
+    '''positions of the entries in rows I and columns J, along with the
+    sparsity pattern of the submatrix they form'''
+
+    key = 'submatrix', I.tobytes(), J.tobytes()
+    try:
+      return self.cache[key]
+    except KeyError:
+      pass
+    rows, cols = divmod( self.index, self.shape[1] )
+    select, = numpy.where( I[rows] & J[cols] )
+    renumber = numpy.cumsum( I ) - 1, numpy.cumsum( J ) - 1
+    nrows, ncols = I.sum(), J.sum()
+    subpattern = SparsityPattern( renumber[0][rows[select]] * ncols + renumber[1][cols[select]], (nrows,ncols) )
+    self.cache[key] = select, subpattern
+    return select, subpattern
+
+  def factorize( self, data, factor, **kwargs ):
+    '''Sparse LU factorization with scipy function factor (splu or spilu) of
+    the matrix with given data. The column ordering of the first factorization
+    is kept per factor function and reused for all subsequent ones.'''
+
+    csc = self.tocsr( data ).tocsc()
+    key = 'permc', factor.__name__
+    perm = self.cache.get( key )
+    if perm is None:
+      lu = factor( csc, **kwargs )
+      self.cache[key] = numpy.argsort( lu.perm_c )
+      return lu.solve
+    kwargs['permc_spec'] = 'NATURAL'
+    lu = factor( csc[:,perm], **kwargs )
+    def solve( b, _solve=lu.solve, _perm=perm ):
+      x = numpy.empty_like( b )
+      x[_perm] = _solve( b )
+      return x
+    return solve
+
+  def amg( self, data, **kwargs ):
+    '''Smoothed aggregation multigrid cycle for the matrix with given data. The
+    aggregates of the first setup are kept and reused for all subsequent ones,
+    leaving only the numerical part of the setup to be redone.'''
+
+    cycle, aggregates = amg( self.tocsr( data ), aggregates=self.cache.get( 'amg' ), **kwargs )
+    self.cache['amg'] = aggregates
+    return cycle
+
+class ScipyMatrix( Matrix ):
+  '''matrix based on any of scipy's sparse matrices, optionally with the
+  sparsity pattern of which it shares the index arrays'''
+
+  def __init__( self, core, pattern=None ):
+    self.core = core
+    self.pattern = pattern
+    self._factors = {}
+    Matrix.__init__( self, core.shape )
+
+  def __getstate__( self ):
+    'state without factorizations, which cannot be pickled'
+
+    state = self.__dict__.copy()
+    state['_factors'] = {}
+    return state
+
+  def update( self, data ):
+    '''refill the matrix in place with new data in the order of its sparsity
+    pattern, as obtained from assembly with the same pattern'''
+
+    assert self.pattern is not None, 'matrix has no sparsity pattern'
+    self.core.data[:] = data
+    self._factors.clear()
+
+  def factorize( self, constrain=None, lconstrain=None, rconstrain=None ):
+    '''sparse LU factorization of the constrained matrix, returned as a
+    function that solves for one or more right-hand sides (columns). The
+    factorization is kept until the matrix is updated.'''
+
+    x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
+    return self._factorize( I, J )
+
+  def _factorize( self, I, J ):
+    import scipy.sparse.linalg
+    key = I.tobytes(), J.tobytes()
+    try:
+      return self._factors[key]
+    except KeyError:
+      pass
+    log.info( 'factorizing %dx%d matrix' % ( I.sum(), J.sum() ) )
+    if self.pattern is not None:
+      select, pattern = self.pattern.submatrix( I, J )
+      solve = pattern.factorize( self.core.data[select], scipy.sparse.linalg.splu )
+    else:
+      solve = scipy.sparse.linalg.splu( self.core[I,:][:,J].tocsc() ).solve
+    self._factors[key] = solve
+    return solve
+
+  matvec = lambda self, vec: self.core.dot( vec )
+  toarray = lambda self: self.core.toarray()
+  toscipy = lambda self: self.core
+  __add__ = lambda self, other: ScipyMatrix( self.core + other.toscipy() )
+  __sub__ = lambda self, other: ScipyMatrix( self.core - other.toscipy() )
+  __mul__ = lambda self, other: ScipyMatrix( self.core * other )
+  __rmul__ = __mul__
+  __div__ = lambda self, other: ScipyMatrix( self.core / other )
+  T = property( lambda self: ScipyMatrix( self.core.transpose() ) )
+
+  def rowsupp( self, tol=0 ):
+    'return row indices with nonzero/non-small entries'
+
+    supp = numpy.empty( self.shape[0], dtype=bool )
+    for irow in range( self.shape[0] ):
+      a, b = self.core.indptr[irow:irow+2]
+      supp[irow] = a != b and ( tol == 0 or numpy.any( numpy.abs( self.core.data[a:b] ) > tol ) )
+    return supp
+
   def getprecon( self, name='SPLU', constrain=None, lconstrain=None, rconstrain=None ):
 
     import scipy.sparse.linalg
 
     name = name.lower()
     x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
-    A = self.core[I,:][:,J]
+    if self.pattern is not None:
+      select, pattern = self.pattern.submatrix( I, J )
+      data = self.core.data[select]
+      A = pattern.tocsr( data )
+    else:
+      A = self.core[I,:][:,J]
     assert A.shape[0] == A.shape[1], 'constrained matrix must be square'
     log.info( 'building %s preconditioner' % name )
     if name == 'splu':
-      precon = scipy.sparse.linalg.splu( A.tocsc() ).solve
+      precon = pattern.factorize( data, scipy.sparse.linalg.splu ) if self.pattern is not None \
+          else scipy.sparse.linalg.splu( A.tocsc() ).solve
     elif name == 'spilu':
-      precon = scipy.sparse.linalg.spilu( A.tocsc(), drop_tol=1e-5, fill_factor=None, drop_rule=None, permc_spec=None, diag_pivot_thresh=None, relax=None, panel_size=None, options=None ).solve
+      precon = pattern.factorize( data, scipy.sparse.linalg.spilu, drop_tol=1e-5 ) if self.pattern is not None \
+          else scipy.sparse.linalg.spilu( A.tocsc(), drop_tol=1e-5, fill_factor=None, drop_rule=None, permc_spec=None, diag_pivot_thresh=None, relax=None, panel_size=None, options=None ).solve
+    elif name == 'amg':
+      precon = pattern.amg( data ) if self.pattern is not None \
+          else amg( A.tocsr() )[0]
     elif name == 'diag':
       precon = numpy.reciprocal( A.diagonal() ).__mul__
     else:
       raise Exception( 'invalid preconditioner %r' % name )
     return scipy.sparse.linalg.LinearOperator( A.shape, precon, dtype=float )
 
+class BlockMatrix( ScipyMatrix ):
+  '''scipy matrix that is partitioned in square diagonal blocks of given
+  lengths, such as formed by chained functions, which additionally offers
+  block triangular and schur complement preconditioners'''
+
+  def __init__( self, core, lengths, pattern=None ):
+    assert core.shape[0] == core.shape[1] == sum( lengths )
+    self.offsets = numpy.cumsum( [0] + list(lengths) )
+    ScipyMatrix.__init__( self, core, pattern )
+
+  def block( self, i, j ):
+    'submatrix of rows in block i and columns in block j'
+
+    return ScipyMatrix( self.core[self.offsets[i]:self.offsets[i+1],self.offsets[j]:self.offsets[j+1]] )
+
+  def getprecon( self, name='SPLU', constrain=None, lconstrain=None, rconstrain=None, blockprecon='splu' ):
+    '''Preconditioner; in addition to those of ScipyMatrix, 'blocktriangular'
+    solves the block upper triangular system and 'schur' the block LDU
+    factorization. In both the diagonal blocks are replaced by approximate
+    schur complements, formed with the inverse diagonals of the preceding
+    ones, which are solved by preconditioner blockprecon of ScipyMatrix, such
+    as splu (direct), spilu or amg. It can also be selected as a suffix of
+    name, as in 'schur:amg', for use in solve. Blocks with zero diagonal
+    entries, such as a pressure block, must therefore come last.'''
+
+    import scipy.sparse, scipy.sparse.linalg
+
+    lname, sep, blockname = name.lower().partition( ':' )
+    if sep:
+      blockprecon = blockname
+    if lname not in ( 'blocktriangular', 'schur' ):
+      return ScipyMatrix.getprecon( self, name, constrain, lconstrain, rconstrain )
+    x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
+    A = self.core[I,:][:,J].tocsr()
+    roffsets = numpy.concatenate( [ [0], numpy.cumsum( I )[self.offsets[1:]-1] ] )
+    coffsets = numpy.concatenate( [ [0], numpy.cumsum( J )[self.offsets[1:]-1] ] )
+    nblocks = len(self.offsets) - 1
+    blocks = [ [ A[roffsets[i]:roffsets[i+1],coffsets[j]:coffsets[j+1]] for j in range(nblocks) ] for i in range(nblocks) ]
+    log.info( 'building %s preconditioner for %d blocks with %s' % ( lname, nblocks, blockprecon ) )
+    schur = []
+    invdiags = []
+    for k in range( nblocks ):
+      S = blocks[k][k]
+      for j in range( k ):
+        S = S - blocks[k][j].dot( invdiags[j] ).dot( blocks[j][k] )
+      schur.append( S.tocsr() )
+      if k < nblocks-1:
+        diag = schur[k].diagonal()
+        if not diag.all():
+          raise Exception( '%s preconditioner requires nonzero diagonals in all but the last block; block %d has %d zeros' % ( lname, k, (diag==0).sum() ) )
+        invdiags.append( scipy.sparse.diags( numpy.reciprocal( diag ) ) )
+    solves = [ ScipyMatrix( S ).getprecon( blockprecon ).matvec for S in schur ]
+
+    def precon( r ):
+      r = [ r[roffsets[k]:roffsets[k+1]] for k in range( nblocks ) ]
+      if lname == 'schur': # forward elimination of the lower blocks
+        for k in range( 1, nblocks ):
+          r[k] = r[k] - util.sum( blocks[k][j].dot( solves[j]( r[j] ) ) for j in range( k ) )
+      x = [ None ] * nblocks
+      for k in reversed( range( nblocks ) ): # backward substitution
+        x[k] = solves[k]( r[k] - util.sum( blocks[k][j].dot( x[j] ) for j in range( k+1, nblocks ) ) if k < nblocks-1 else r[k] )
+      return numpy.concatenate( x )
+
+    return scipy.sparse.linalg.LinearOperator( A.shape, precon, dtype=float )
+
+class MatrixFree( Matrix ):
+  '''linear operator that is applied by a function rather than stored, such as
+  formed by Topology.operator, with its diagonal for preconditioning'''
+
+  def __init__( self, matvec, diagonal, shape ):
+    self.matvec = matvec
+    self.diagonal = diagonal
+    Matrix.__init__( self, shape )
+
+  def toarray( self ):
+    'dense matrix, formed by application to all unit vectors'
+
+    return numpy.array([ self.matvec( e ) for e in numpy.eye( self.shape[1] ) ]).T
+
+  def solve( self, b=None, constrain=None, lconstrain=None, rconstrain=None, tol=0, solver=None, **kwargs ):
+    'solve iteratively for a single right-hand side'
+
+    if not tol or solver == 'direct':
+      raise Exception( 'matrix free operator cannot be factorized; solve iteratively by specifying tol' )
+    if b is not None and numpy.ndim( b ) != 1:
+      raise Exception( 'matrix free operator solves for a single right-hand side, got shape %s' % (numpy.shape(b),) )
+    return Matrix.solve( self, b, constrain, lconstrain, rconstrain, tol=tol, solver=solver, **kwargs )
+
+  def _factorize( self, I, J ):
+    raise Exception( 'matrix free operator cannot be factorized; solve iteratively by specifying tol' )
+
+  def getprecon( self, name='diag', constrain=None, lconstrain=None, rconstrain=None ):
+
+    import scipy.sparse.linalg
+
+    name = name.lower()
+    x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
+    assert ( I == J ).all(), 'diagonal preconditioner requires symmetric constraints'
+    if name != 'diag':
+      raise Exception( 'invalid preconditioner %r for matrix free operator' % name )
+    return scipy.sparse.linalg.LinearOperator( (I.sum(),)*2, numpy.reciprocal( self.diagonal[I] ).__mul__, dtype=float )
+
 class NumpyMatrix( Matrix ):
   '''matrix based on numpy array'''
 
@@ -174,10 +419,12 @@ class NumpyMatrix( Matrix ):
       b = numpy.zeros( self.shape[0] )
     else:
       b = numpy.asarray( b, dtype=float )
-      assert b.ndim == 1, 'right-hand-side has shape %s, expected a vector' % (b.shape,)
-      assert b.shape == self.shape[:1]
+      assert b.ndim in (1,2), 'right-hand-side has shape %s, expected a vector or matrix' % (b.shape,)
+      assert b.shape[0] == self.shape[0]
 
     x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
+    if b.ndim == 2:
+      x = numpy.repeat( x[:,numpy.newaxis], b.shape[1], axis=1 )
     if I.all() and J.all():
       return numpy.linalg.solve( self.core, b )
 
@@ -189,10 +436,21 @@ class NumpyMatrix( Matrix ):
 # UTILITY FUNCTIONS
 
 def assemble( data, index, shape, force_dense=False ):
-  'create data from values and indices'
+  '''create data from values and indices, the latter either an ndim x n array
+  of possibly repeated indices, a sorted array of distinct flat indices, or a
+  sparsity pattern'''
 
   if len(shape) == 0:
     retval = data.sum()
+  elif isinstance( index, SparsityPattern ) and not force_dense:
+    assert index.shape == shape
+    retval = ScipyMatrix( index.tocsr( data ), index )
+  elif isinstance( index, SparsityPattern ) or index.ndim == 1:
+    retval = numpy.zeros( numpy.prod(shape), dtype=data.dtype )
+    retval[ getattr( index, 'index', index ) ] = data
+    retval = retval.reshape( shape )
+    if retval.ndim == 2:
+      retval = NumpyMatrix( retval )
   elif len(shape) == 2 and not force_dense:
     import scipy.sparse.linalg
     csr = scipy.sparse.csr_matrix( (data,index), shape )
@@ -206,6 +464,71 @@ def assemble( data, index, shape, force_dense=False ):
   log.debug( 'assembled', '%s(%s)' % ( retval.__class__.__name__, ','.join( str(n) for n in shape ) ) )
   return retval
 
+def amg( A, aggregates=None, maxcoarse=100, maxlevels=10, theta=.08 ):
+  """Smoothed aggregation algebraic multigrid for sparse matrix A. Returns a
+  symmetric V-cycle with damped Jacobi smoothing and a direct solve on the
+  coarsest level, along with the aggregates per level for reuse. Constant
+  vectors are taken as the near null space."""
+
+  import scipy.sparse, scipy.sparse.linalg
+
+  levels = []
+  newaggregates = []
+  while True:
+    A = A.tocsr()
+    if aggregates is not None:
+      if len(levels) == len(aggregates):
+        break
+    elif A.shape[0] <= maxcoarse or len(levels) == maxlevels-1:
+      break
+    dinv = numpy.reciprocal( A.diagonal() )
+    DinvA = scipy.sparse.diags( dinv ).dot( A ).tocsr()
+    omega = 4. / ( 3. * numpy.max( abs( DinvA ).sum( axis=1 ) ) ) # gershgorin bound on spectral radius
+    agg = aggregates[len(levels)] if aggregates is not None else _aggregate( A, theta )
+    naggs = agg.max() + 1
+    if aggregates is None and naggs == A.shape[0]:
+      break
+    T = scipy.sparse.csr_matrix( ( 1 / numpy.sqrt( numpy.bincount( agg )[agg] ), agg, numpy.arange( A.shape[0]+1 ) ), (A.shape[0],naggs) )
+    P = ( T - omega * DinvA.dot( T ) ).tocsr()
+    levels.append(( A, P, P.T.tocsr(), omega * dinv ))
+    newaggregates.append( agg )
+    A = P.T.dot( A.dot( P ) )
+  log.info( 'multigrid with %d levels, coarsest %dx%d' % ( len(levels)+1, A.shape[0], A.shape[1] ) )
+  coarsesolve = scipy.sparse.linalg.splu( A.tocsc() ).solve
+
+  def cycle( b, level=0 ):
+    if level == len(levels):
+      return coarsesolve( b )
+    A, P, R, wdinv = levels[level]
+    x = wdinv * b
+    x += P.dot( cycle( R.dot( b - A.dot(x) ), level+1 ) )
+    x += wdinv * ( b - A.dot(x) )
+    return x
+
+  return cycle, newaggregates
+
+def _aggregate( A, theta ):
+  'greedy aggregation of the strongly connected nodes of sparse matrix A'
+
+  import scipy.sparse
+  A = A.tocoo()
+  diag = abs( A.diagonal() )
+  strong = ( A.row != A.col ) & ( abs( A.data ) >= theta * numpy.sqrt( diag[A.row] * diag[A.col] ) )
+  S = scipy.sparse.csr_matrix( ( numpy.ones( strong.sum() ), (A.row[strong],A.col[strong]) ), A.shape )
+  S = ( S + S.T ).tocsr()
+  indptr, indices = S.indptr, S.indices
+  agg = -numpy.ones( A.shape[0], dtype=int )
+  naggs = 0
+  for i in range( A.shape[0] ): # aggregate free nodes with all their free neighbours
+    nbrs = indices[indptr[i]:indptr[i+1]]
+    if agg[i] == -1 and ( agg[nbrs] == -1 ).all():
+      agg[i] = agg[nbrs] = naggs
+      naggs += 1
+  for i in numpy.where( agg == -1 )[0]: # attach remaining nodes to a neighbouring aggregate
+    nbrs = indices[indptr[i]:indptr[i+1]]
+    agg[i] = agg[nbrs][ agg[nbrs] != -1 ][0]
+  return agg
+
 def parsecons( constrain, lconstrain, rconstrain, shape ):
   'parse constraints'
 
@@ -15,11 +15,13 @@ will disable and a warning is printed.
 
 from __future__ import print_function, division
 from . import core, log, numpy, debug, numeric
-import os, sys, multiprocessing
+import os, sys, multiprocessing, threading
 
 Lock = multiprocessing.Lock
 cpu_count = multiprocessing.cpu_count
 
+_worker = threading.local() # iproc of current process or thread
+
 class Fork( object ):
   'nested fork context, unwinds at exit'
 
@@ -38,6 +40,7 @@ class Fork( object ):
     else:
       self.child_pid = None
       self.iproc = self.nprocs-1
+    _worker.iproc = self.iproc
     return self.iproc
 
   def __exit__( self, *exc_info ):
@@ -91,6 +94,7 @@ class AlternativeFork( object ):
     else:
       self.children = children
       self.iproc = 0
+    _worker.iproc = self.iproc
     return self.iproc
 
   def __exit__( self, *exc_info ):
@@ -147,53 +151,623 @@ def fork( func, nice=19 ):
 
   return wrapped
 
+class Pool( object ):
+  '''Persistent group of nprocs processes that execute the same code, formed by
+  forking on entering the context and unwinding at exit. Within the context
+  pariter loops are divided among the processes without forking, and shzeros
+  arrays are taken from a shared memory arena of shmsize megabytes, which is
+  allocated by the first process and returned for reuse as its arrays are
+  released. Arrays that do not fit get a shared mapping of their own, which
+  is released with the array. The other processes keep their own evaluation
+  caches, which therefore remain warm for the duration of the context.'''
+
+  COUNT, GENERATION, FAILED, OFFSET, ITER = range(5)
+
+  def __init__( self, nprocs ):
+    'constructor'
+
+    import mmap
+    self.nprocs = nprocs
+    self.size = core.getprop( 'shmsize', 1024 ) * 2**20
+    self.arena = mmap.mmap( -1, self.size )
+    self.free = [ (0,self.size) ]
+    self.allocated = {}
+    self.state = multiprocessing.RawArray( 'l', 7 )
+    self.condition = multiprocessing.Condition()
+    self.niter = 0
+    self.noverflow = 0
+    self.masterpid = os.getpid()
+    self.children = None
+
+  def __enter__( self ):
+    'fork and return iproc'
+
+    children = []
+    for self.iproc in range( 1, self.nprocs ):
+      child_pid = os.fork()
+      if not child_pid:
+        break
+      children.append( child_pid )
+    else:
+      self.children = children
+      self.iproc = 0
+    _worker.iproc = self.iproc
+    return self.iproc
+
+  def __exit__( self, *exc_info ):
+    'kill all processes but first one'
+
+    exctype, excvalue, tb = exc_info
+    status = 0
+    try:
+      if exctype:
+        self.abort()
+        if self.iproc:
+          log.stack( exc_info )
+        status = 1
+      while self.children:
+        child_pid, child_status = os.wait()
+        self.children.remove( child_pid )
+        if child_status:
+          status = 1
+    except: # should not happen.. but just to be sure
+      status = 1
+    if self.iproc:
+      sys.stdout.flush()
+      os._exit( status )
+    if not exctype:
+      assert status == 0, 'one or more subprocesses failed'
+
+  def abort( self ):
+    'release all processes waiting in barrier with an exception'
+
+    with self.condition:
+      self.state[self.FAILED] = 1
+      self.condition.notify_all()
+
+  def barrier( self ):
+    'wait for all processes to arrive'
+
+    with self.condition:
+      generation = self.state[self.GENERATION]
+      self.state[self.COUNT] += 1
+      if self.state[self.COUNT] == self.nprocs:
+        self.state[self.COUNT] = 0
+        self.state[self.GENERATION] = generation + 1
+        self.condition.notify_all()
+      while self.state[self.GENERATION] == generation and not self.state[self.FAILED]:
+        self.condition.wait()
+      if self.state[self.FAILED]:
+        raise Exception( 'another process in the pool failed' )
+
+  def iter( self, iterable, length=None ):
+    'iterate parallel, dividing items among the processes of the pool'
+
+    counter = self.ITER + self.niter % 2
+    self.niter += 1
+    if not self.iproc:
+      self.state[ self.ITER + self.niter % 2 ] = 0 # reset counter of next loop
+    try:
+      for it in _guided( iterable, length, self.nprocs, self.state, counter, self.condition ):
+        yield it
+    except GeneratorExit: # loop left early, the other processes finish it
+      self.barrier()
+      raise
+    except:
+      self.abort()
+      raise
+    self.barrier()
+
+  def shzeros( self, shape, dtype ):
+    'create zero-initialized array in the shared memory arena'
+
+    import weakref
+    dtype = numpy.dtype( dtype )
+    count = int( numpy.prod( shape ) )
+    nbytes = max( count * dtype.itemsize, 1 )
+    nbytes += -nbytes % 64 # align next allocation
+    if not self.iproc:
+      fits = [ i for i, (offset, size) in enumerate( self.free ) if size >= nbytes ]
+      if fits:
+        offset, size = self.free[fits[0]]
+        self.free[fits[0]] = offset + nbytes, size - nbytes
+      else:
+        offset = -1 # arena exhausted
+      self.state[self.OFFSET] = offset
+    self.barrier() # all processes are done with previously released memory
+    offset = self.state[self.OFFSET]
+    if offset < 0:
+      return self._overflow( shape, dtype, count, nbytes )
+    array = numpy.frombuffer( self.arena, dtype, count, offset )
+    if not self.iproc:
+      numpy.frombuffer( self.arena, numpy.uint8, nbytes, offset ).fill( 0 )
+    self.barrier() # all processes have read offset and see zeroed memory
+    if not self.iproc:
+      self.allocated[offset] = weakref.ref( array, lambda ref: self._release( offset, nbytes ) ), nbytes
+    return array.reshape( shape )
+
+  def _overflow( self, shape, dtype, count, nbytes ):
+    'create zero-initialized array in a shared mapping of its own'
+
+    import mmap, tempfile
+    shmdir = '/dev/shm' if os.path.isdir( '/dev/shm' ) else tempfile.gettempdir()
+    path = os.path.join( shmdir, 'nutils-pool-%d-%d' % ( self.masterpid, self.noverflow ) )
+    self.noverflow += 1
+    if not self.iproc:
+      log.warning( 'shared memory arena of %dMB exhausted, mapping %.1fMB separately; consider increasing shmsize' % ( self.size // 2**20, nbytes / 2.**20 ) )
+      try:
+        with open( path, 'wb' ) as f:
+          f.truncate( nbytes ) # zero-initialized
+      except:
+        self.abort()
+        raise Exception( 'failed to map %.1fMB of shared memory in %s beyond the arena of %dMB; increase shmsize' % ( nbytes / 2.**20, shmdir, self.size // 2**20 ) )
+    self.barrier() # file exists
+    with open( path, 'r+b' ) as f:
+      buf = mmap.mmap( f.fileno(), nbytes )
+    self.barrier() # all processes have mapped the file
+    if not self.iproc:
+      os.unlink( path )
+    return numpy.frombuffer( buf, dtype, count ).reshape( shape )
+
+  def _release( self, offset, nbytes ):
+    'return memory to the arena, merging adjacent free intervals'
+
+    del self.allocated[offset]
+    free = sorted( self.free + [ (offset,nbytes) ] )
+    self.free = free[:1]
+    for offset, size in free[1:]:
+      lastoffset, lastsize = self.free[-1]
+      if lastoffset + lastsize == offset:
+        self.free[-1] = lastoffset, lastsize + size
+      else:
+        self.free.append(( offset, size ))
+
+def pool( func ):
+  '''Run func in all processes of a Pool of nprocs processes and return the
+  result of the first. All pariter loops and shzeros arrays within func are
+  shared by the pool; any other code runs in every process, with log output of
+  all but the first process limited to errors. Output files and other side
+  effects can be restricted to the first process by testing ismaster().'''
+
+  if not hasattr( os, 'fork' ):
+    log.warning( 'fork does not exist on this platform; running %s in serial' % func.__name__ )
+    return func
+
+  def wrapped( *args, **kwargs ):
+    nprocs = core.getprop( 'nprocs', 1 )
+    if nprocs <= 1:
+      return func( *args, **kwargs )
+    __pool__ = Pool( nprocs )
+    with __pool__ as iproc:
+      if iproc:
+        __verbose__ = 2
+      return func( *args, **kwargs )
+
+  return wrapped
+
+class SocketComm( object ):
+  '''Communicator between size ranks connected by sockets, of which this
+  is rank. Every rank listens on its own (host,port) address and connects to
+  all lower ranks, for which the listening socket may be passed if it is
+  already bound. Objects are sent pickled, prefixed by their length.'''
+
+  def __init__( self, rank, addresses, listener=None, timeout=60 ):
+    'constructor'
+
+    import socket, struct, time
+    self.rank = rank
+    self.size = len(addresses)
+    if listener is None:
+      listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      listener.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+      listener.bind( addresses[rank] )
+      listener.listen( self.size )
+    self.sockets = [ None ] * self.size
+    for peer in range( rank ):
+      tstop = time.time() + timeout
+      while True:
+        try:
+          sock = socket.create_connection( addresses[peer] )
+        except socket.error:
+          if time.time() > tstop:
+            raise
+          time.sleep( .1 ) # peer not listening yet
+        else:
+          break
+      sock.sendall( struct.pack( '<Q', rank ) )
+      self.sockets[peer] = sock
+    for i in range( self.size - rank - 1 ):
+      sock, address = listener.accept()
+      peer, = struct.unpack( '<Q', self._recvall( sock, 8 ) )
+      self.sockets[peer] = sock
+    listener.close()
+    for sock in self.sockets:
+      if sock is not None:
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+  @staticmethod
+  def _recvall( sock, nbytes ):
+    buf = bytearray( nbytes )
+    view = memoryview( buf )
+    while nbytes:
+      n = sock.recv_into( view[-nbytes:], nbytes )
+      if not n:
+        raise Exception( 'connection closed by peer' )
+      nbytes -= n
+    return bytes( buf )
+
+  def send( self, obj, dest ):
+    'send obj to rank dest'
+
+    import pickle, struct
+    data = pickle.dumps( obj, pickle.HIGHEST_PROTOCOL )
+    sock = self.sockets[dest]
+    sock.sendall( struct.pack( '<Q', len(data) ) )
+    sock.sendall( data )
+
+  def recv( self, source ):
+    'receive object from rank source'
+
+    import pickle, struct
+    sock = self.sockets[source]
+    nbytes, = struct.unpack( '<Q', self._recvall( sock, 8 ) )
+    return pickle.loads( self._recvall( sock, nbytes ) )
+
+  def reduce( self, obj, op ):
+    'combine objects of all ranks with op along a binary tree, result on rank 0'
+
+    step = 1
+    while step < self.size:
+      if self.rank % (2*step):
+        self.send( obj, self.rank - step )
+        return None
+      if self.rank + step < self.size:
+        obj = op( obj, self.recv( self.rank + step ) )
+      step *= 2
+    return obj
+
+  def bcast( self, obj ):
+    'distribute object of rank 0 to all ranks along a binary tree'
+
+    step = 1
+    while step < self.size:
+      step *= 2
+    while step > 1:
+      step //= 2
+      if self.rank % (2*step) == step:
+        obj = self.recv( self.rank - step )
+      elif self.rank % (2*step) == 0 and self.rank + step < self.size:
+        self.send( obj, self.rank + step )
+    return obj
+
+  def allreduce( self, obj, op ):
+    'combine objects of all ranks with op, result on all ranks'
+
+    return self.bcast( self.reduce( obj, op ) )
+
+  def close( self ):
+    for sock in self.sockets:
+      if sock is not None:
+        sock.close()
+
+def localcluster( func ):
+  '''Run func in nranks processes on the local machine that are connected by a
+  SocketComm over localhost, as a stand-in for a cluster, and return the
+  result of rank 0. The communicator is available as the comm property, which
+  distributed operations such as Topology.integrate act upon. Log output of
+  all but the first rank is limited to errors.'''
+
+  if not hasattr( os, 'fork' ):
+    log.warning( 'fork does not exist on this platform; running %s in serial' % func.__name__ )
+    return func
+
+  def wrapped( *args, **kwargs ):
+    import socket
+    nranks = core.getprop( 'nranks', 1 )
+    if nranks <= 1:
+      return func( *args, **kwargs )
+    listeners = []
+    for rank in range( nranks ):
+      listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      listener.bind(( '127.0.0.1', 0 ))
+      listener.listen( nranks )
+      listeners.append( listener )
+    addresses = [ listener.getsockname() for listener in listeners ]
+    with AlternativeFork( nranks ) as rank:
+      for i, listener in enumerate( listeners ):
+        if i != rank:
+          listener.close()
+      __comm__ = SocketComm( rank, addresses, listeners[rank] )
+      if rank:
+        __verbose__ = 2
+      try:
+        return func( *args, **kwargs )
+      finally:
+        __comm__.close()
+
+  return wrapped
+
+def ismaster():
+  'true unless running in a secondary process of a pool'
+
+  pool = core.getprop( 'pool', None )
+  return pool is None or pool.iproc == 0
+
 def shzeros( shape, dtype=float ):
-  'create zero-initialized array in shared memory'
+  'create zero-initialized array of any dtype in shared memory'
 
   # return numpy.zeros( shape, dtype=dtype ) # TODO: toggle to numpy for debugging
   if numeric.isint( shape ):
     shape = shape,
   else:
     assert all( numeric.isint(sh) for sh in shape )
-  size = numpy.product( shape ) if shape else 1
-  if dtype == float:
-    typecode = 'd'
-    dtype = numpy.float64
-  elif dtype == int:
-    typecode = 'i'
-    dtype = numpy.int32
+  pool = core.getprop( 'pool', None )
+  if pool is not None:
+    return pool.shzeros( shape, dtype )
+  import mmap
+  dtype = numpy.dtype( dtype )
+  count = int( numpy.prod( shape ) )
+  buf = mmap.mmap( -1, max( count * dtype.itemsize, 1 ) ) # anonymous, hence zero-initialized and shared
+  return numpy.frombuffer( buf, dtype, count ).reshape( shape )
+
+def workerid():
+  'index of the current process in a parallel loop, or of the current thread'
+
+  return getattr( _worker, 'iproc', 0 )
+
+def pariter( iterable, length=None ):
+  '''iterate parallel, with every process claiming chunks of consecutive items
+  that shrink towards the end of the loop; unless length is specified it is
+  taken from the iterable if possible, and chunks otherwise contain one item.
+  The body of a loop cannot be divided among threads, hence if the threads
+  property is set the loop runs serially, with a warning; see parfor.'''
+
+  if length is None:
+    try:
+      length = len( iterable )
+    except TypeError:
+      pass
+  pool = core.getprop( 'pool', None )
+  if pool is not None:
+    return pool.iter( iterable, length )
+  nprocs = core.getprop( 'nprocs', 1 )
+  if nprocs <= 1:
+    return iterable
+  if core.getprop( 'threads', False ):
+    log.warning( 'pariter runs serially with threads; use parfor to divide the loop among %d threads' % nprocs )
+    return iterable
+  return _pariter( iterable, length, nprocs )
+
+def parfor( func, iterable, length=None ):
+  '''Call func for all items in parallel, using nprocs threads if the threads
+  property is set and pariter otherwise. Threads share all memory and caches,
+  and are effective if func spends most of its time in numpy operations that
+  release the global interpreter lock.'''
+
+  nprocs = core.getprop( 'nprocs', 1 )
+  if nprocs > 1 and core.getprop( 'threads', False ) and core.getprop( 'pool', None ) is None:
+    if length is None:
+      try:
+        length = len( iterable )
+      except TypeError:
+        pass
+    _parfor_threads( func, iterable, length, nprocs )
   else:
-    raise Exception( 'invalid dtype: %r' % dtype )
-  buf = multiprocessing.RawArray( typecode, int(size) )
-  return numpy.frombuffer( buf, dtype ).reshape( shape )
+    for item in pariter( iterable, length ):
+      func( item )
 
-def pariter( iterable ):
-  'iterate parallel'
+def parloop( func, iterable ):
+  """Loop that calls func for all items of iterable in parallel every time it
+  is called. Unlike parfor, the processes are forked once, on creation, and
+  then wait for the next call, such that their evaluation caches remain warm;
+  data that changes between calls is passed through shzeros arrays created
+  beforehand. With threads or within a pool, which share caches already, or
+  with a single process, every call is a parfor loop."""
 
+  items = tuple( iterable )
   nprocs = core.getprop( 'nprocs', 1 )
-  return iterable if nprocs <= 1 else _pariter( iterable, nprocs )
+  if nprocs <= 1 or core.getprop( 'threads', False ) or core.getprop( 'pool', None ) is not None or not hasattr( os, 'fork' ):
+    return lambda: parfor( func, items )
+  return _ParLoop( func, items, nprocs )
+
+class _ParLoop( object ):
+  'persistent parallel loop, helper class of parloop'
+
+  GENERATION, DONE, FAILED, ITER = range(4)
+
+  def __init__( self, func, items, nprocs ):
+    'fork the processes that serve the loop'
 
-def _pariter( iterable, nprocs ):
+    self.func = func
+    self.items = items
+    self.nprocs = nprocs
+    self.state = multiprocessing.RawArray( 'l', 4 )
+    self.condition = multiprocessing.Condition()
+    self.masterpid = os.getpid()
+    self.children = []
+    for iproc in range( 1, nprocs ):
+      child_pid = os.fork()
+      if not child_pid:
+        self._serve( iproc ) # does not return
+      self.children.append( child_pid )
+
+  def _serve( self, iproc ):
+    'run the loop on every call of the first process until closed'
+
+    __verbose__ = 2
+    _worker.iproc = iproc
+    generation = 0
+    try:
+      while True:
+        with self.condition:
+          while self.state[self.GENERATION] == generation:
+            self.condition.wait( 1 )
+            if os.getppid() != self.masterpid: # first process ended without closing
+              os._exit( 1 )
+          generation = self.state[self.GENERATION]
+        if generation < 0:
+          break
+        try:
+          self._run()
+        except:
+          log.stack( sys.exc_info() )
+          self.state[self.FAILED] = 1
+        with self.condition:
+          self.state[self.DONE] += 1
+          self.condition.notify_all()
+    finally:
+      sys.stdout.flush()
+      os._exit( 0 )
+
+  def _run( self ):
+    for item in _guided( self.items, len(self.items), self.nprocs, self.state, self.ITER, self.condition ):
+      self.func( item )
+
+  def __call__( self ):
+    'run the loop in all processes'
+
+    assert self.children, 'loop is closed'
+    with self.condition:
+      self.state[self.DONE] = self.state[self.FAILED] = self.state[self.ITER] = 0
+      self.state[self.GENERATION] += 1
+      self.condition.notify_all()
+    try:
+      self._run()
+    finally:
+      exited = self._wait()
+    if exited:
+      self.close()
+      raise Exception( 'parallel loop failed: %d process(es) exited unexpectedly' % len(exited) )
+    if self.state[self.FAILED]:
+      raise Exception( 'parallel loop failed in another process' )
+
+  def _wait( self ):
+    '''wait for all processes to finish the loop, checking every second that
+    they are alive; return the pids of those that exited'''
+
+    exited = []
+    with self.condition:
+      while self.state[self.DONE] < len(self.children):
+        self.condition.wait( 1 )
+        if self.state[self.DONE] < len(self.children):
+          exited = [ pid for pid in self.children if os.waitpid( pid, os.WNOHANG )[0] ]
+          if exited:
+            break
+    for pid in exited:
+      self.children.remove( pid )
+    return exited
+
+  def close( self ):
+    'end the processes that serve the loop'
+
+    if self.children and os.getpid() == self.masterpid:
+      with self.condition:
+        self.state[self.GENERATION] = -1
+        self.condition.notify_all()
+      while self.children:
+        waitpid_noerr( self.children.pop() )
+
+  __del__ = close
+
+def _parfor_threads( func, iterable, length, nthreads ):
+  'call func for all items in threads, helper function'
+
+  import itertools
+  properties = core.getprops()
+  iterator = iter( iterable )
+  lock = threading.Lock()
+  claimed = [ 0 ]
+  failed = []
+
+  def claim():
+    with lock:
+      if failed:
+        return []
+      size = _chunksize( length, claimed[0], nthreads )
+      items = list( itertools.islice( iterator, size ) )
+      claimed[0] += len(items)
+    return items
+
+  def run( ithread ):
+    core.inheritprops( properties )
+    _worker.iproc = ithread
+    try:
+      items = claim()
+      while items:
+        for item in items:
+          func( item )
+        items = claim()
+    except:
+      failed.append( sys.exc_info() )
+
+  threads = [ threading.Thread( target=run, args=(ithread,) ) for ithread in range( nthreads ) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if failed:
+    exctype, excvalue, tb = failed[0]
+    raise excvalue
+
+def _pariter( iterable, length, nprocs ):
   'iterate parallel, helper generator'
 
-  shared_iter = multiprocessing.RawValue( 'i', nprocs )
+  shared_iter = multiprocessing.RawArray( 'l', 1 )
   lock = Lock()
   with Fork( nprocs ) as iproc:
-    iiter = iproc
-    for n, it in enumerate( iterable ):
-      if n < iiter:
-        continue
-      assert n == iiter
+    for it in _guided( iterable, length, nprocs, shared_iter, 0, lock ):
       yield it
-      with lock:
-        iiter = shared_iter.value
-        shared_iter.value = iiter + 1
+
+def _guided( iterable, length, nprocs, counters, icounter, lock ):
+  '''Iterate over the items of chunks claimed from shared counters[icounter],
+  guarded by lock. Chunks are a fraction of the remaining number of items, such
+  that chunks are large at the start of the loop to limit locking, and small
+  towards the end to balance the load of the processes.'''
+
+  def claim():
+    with lock:
+      start = counters[icounter]
+      counters[icounter] = stop = start + _chunksize( length, start, nprocs )
+    return start, stop
+
+  start, stop = claim()
+  for n, it in enumerate( iterable ):
+    if n == stop:
+      start, stop = claim()
+    if n >= start:
+      yield it
+
+def _chunksize( length, start, nprocs ):
+  'number of items to claim from start in a loop of given length'
+
+  return max( 1, ( length - start ) // ( 2 * nprocs ) ) if length else 1
 
 def parmap( func, iterable, shape=(), dtype=float ):
   n = len(iterable)
   out = shzeros( (n,)+shape, dtype=dtype )
-  for i, item in pariter( enumerate(iterable) ):
+  def setitem( arg ):
+    i, item = arg
     out[i] = func( item )
+  parfor( setitem, enumerate(iterable), n )
   return out
 
+def parreduce( func, iterable, shape=(), dtype=float, op=numpy.add ):
+  '''Reduce func(item) for all items with binary ufunc op, such as numpy.add or
+  numpy.maximum. Every process or thread accumulates into its own row of a
+  shared array, which are reduced after the loop, such that no locking is
+  required.'''
+
+  nprocs = core.getprop( 'nprocs', 1 )
+  partial = shzeros( (nprocs,)+shape, dtype=dtype )
+  touched = shzeros( nprocs, dtype=bool )
+  def accumulate( item ):
+    iproc = workerid()
+    partial[iproc] = op( partial[iproc], func( item ) ) if touched[iproc] else func( item )
+    touched[iproc] = True
+  parfor( accumulate, iterable )
+  if not touched.any():
+    assert op.identity is not None, 'reduction of empty sequence with %s' % op.__name__
+    return numpy.zeros( shape, dtype=dtype ) + op.identity
+  return op.reduce( partial[touched], axis=0 )
+
 # vim:shiftwidth=2:foldmethod=indent:foldnestmax=1
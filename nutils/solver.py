@@ -0,0 +1,110 @@
+# -*- coding: utf8 -*-
+#
+# Module SOLVER
+#
+# Part of Nutils: open source numerical utilities for Python. Jointly developed
+# by HvZ Computational Engineering, TU/e Multiscale Engineering Fluid Dynamics,
+# and others. More info at http://nutils.org <info@nutils.org>. (c) 2014
+
+"""
+The solver module provides drivers for nonlinear systems that are formed by
+integration of residual functions, built on :func:`topology.Topology.integrate`
+and the solve methods of the :mod:`matrix` module.
+"""
+
+from __future__ import print_function, division
+from . import function, numpy, log
+import time
+
+
+@log.title
+def newton( topology, residual, target, lhs0, ischeme, geometry=None, constrain=None, jacobian=None, tol=1e-10, maxiter=25, lag=1, rebuild=.5, linesearch=True, minstep=1/64., solvetol=0, precon='splu', info=False, title='newton', **solveargs ):
+  '''Newton iterations for the value lhs of the Argument target that makes the
+  integral of residual vanish in the unconstrained dofs, starting from lhs0.
+  Input arguments:
+  * residual, residual integrand as a function of target
+  * jacobian, its jacobian integrand; defaults to the derivative of the
+              residual by function.derivative
+  * lag,      number of iterations for which a jacobian is used before it is
+              reassembled; 1 for full Newton, 0 for modified Newton
+  * rebuild,  residual reduction factor above which a lagged jacobian is
+              reassembled regardless of lag
+  * solvetol, tolerance of the linear solves; 0 for direct solves
+  * info,     if true, return lhs along with a dictionary holding the number
+              of iterations (niter), of jacobian assemblies (njac), and the
+              residual norm history
+  The factorization or preconditioner of a jacobian is kept for as long as
+  the jacobian is. The step size is halved until the residual norm decreases
+  sufficiently, down to minstep, after reassembling a lagged jacobian first.'''
+
+  if jacobian is None:
+    jacobian = function.derivative( residual, target )
+  if constrain is None:
+    free = numpy.ones( len(lhs0), dtype=bool )
+    lhs = numpy.array( lhs0, dtype=float )
+  else:
+    free = numpy.isnan( constrain )
+    lhs = numpy.where( free, lhs0, constrain )
+  dcons = numpy.where( free, numpy.nan, 0 )
+
+  def integrate( lhs, withjacobian ):
+    arguments = { target.name: lhs }
+    if withjacobian:
+      return topology.integrate( [ residual, jacobian ], ischeme, geometry=geometry, arguments=arguments )
+    return topology.integrate( residual, ischeme, geometry=geometry, arguments=arguments ), None
+
+  res, jac = integrate( lhs, True )
+  norm = numpy.linalg.norm( res[free] )
+  age = 0 # number of updates since assembly of jac
+  njac = 1
+  history = [ norm ]
+  for iiter in log.range( 'iter', maxiter ):
+    if norm <= tol:
+      break
+    t0 = time.time()
+    if age and ( lag and age >= lag or norm > rebuild * history[-2] ):
+      jac = topology.integrate( jacobian, ischeme, geometry=geometry, arguments={ target.name: lhs } )
+      age = 0
+      njac += 1
+    if age == 0:
+      M = jac.getprecon( precon, constrain=dcons ) if solvetol else None
+    dlhs = jac.solve( -res, constrain=dcons, tol=solvetol, precon=M, **solveargs ) if solvetol \
+      else jac.solve( -res, constrain=dcons )
+    step = 1.
+    while True:
+      withjacobian = lag != 0 and age+1 >= lag and step == 1
+      newres, newjac = integrate( lhs + step * dlhs, withjacobian )
+      newnorm = numpy.linalg.norm( newres[free] )
+      if not linesearch or newnorm <= ( 1 - 1e-4 * step ) * norm:
+        break
+      if age:
+        log.info( 'insufficient decrease with lagged jacobian, reassembling' )
+        break
+      step /= 2
+      if step < minstep:
+        raise Exception( 'line search failed to decrease the residual at iteration %d' % iiter )
+    if linesearch and newnorm > ( 1 - 1e-4 * step ) * norm: # lagged jacobian rejected
+      jac = topology.integrate( jacobian, ischeme, geometry=geometry, arguments={ target.name: lhs } )
+      age = 0
+      njac += 1
+      continue
+    lhs = lhs + step * dlhs
+    res, norm = newres, newnorm
+    history.append( norm )
+    if newjac is not None:
+      jac = newjac
+      age = 0
+      njac += 1
+    else:
+      age += 1
+    log.info( 'residual %.2e, step %.3g, jacobian age %d, %.2fs' % ( norm, step, age, time.time()-t0 ) )
+  else:
+    if norm > tol:
+      raise Exception( 'newton failed to converge in %d iterations, residual %.2e' % ( maxiter, norm ) )
+  log.info( 'converged to %.2e with %d jacobians, residual history %s' % ( norm, njac, ' '.join( '%.1e' % r for r in history ) ) )
+  if info:
+    return lhs, dict( niter=len(history)-1, njac=njac, history=history )
+  return lhs
+
+
+# vim:shiftwidth=2:foldmethod=indent:foldnestmax=1
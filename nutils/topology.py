@@ -25,7 +25,7 @@ out in element loops. For lower level operations topologies can be used as
 
 from __future__ import print_function, division
 from . import element, function, util, numpy, parallel, matrix, log, core, numeric, cache, rational, transform, _
-import warnings
+import warnings, weakref
 
 class Topology( object ):
   'topology base class'
@@ -157,6 +157,24 @@ class Topology( object ):
     '''transform -> element mapping'''
     return { elem.transform: elem for elem in self }
 
+  @cache.property
+  def fcache( self ):
+    '''bounded cache of integration schemes, transformed points and shape
+    functions, kept for the lifetime of the topology'''
+    return cache.LRUCache( core.getprop( 'fcachesize', 256 ) * 2**20 )
+
+  @cache.property
+  def patterncache( self ):
+    '''bounded cache of the sparsity patterns of integrals, kept apart from
+    fcache such that large patterns do not compete with shape functions'''
+    return cache.LRUCache( core.getprop( 'patterncachesize', 1024 ) * 2**20 )
+
+  @cache.property
+  def elemcache( self ):
+    '''bounded cache of constant and per element values of evaluables, kept
+    for the lifetime of the topology and dropped with the operations it stores'''
+    return cache.OperationCache( core.getprop( 'fcachesize', 256 ) * 2**20 )
+
   @cache.property
   def transrange( self ):
     nmin = nmax = len(self.elements[0].transform)
@@ -263,9 +281,85 @@ class Topology( object ):
         refined.append( elem )
     return HierarchicalTopology( self, refined )
 
+  def partition( self, nparts, method=None, geometry=None ):
+    '''Split the elements in nparts subtopologies of near equal size, formed by
+    contiguous elements in the current order if method is None, or in the order
+    of method as in reorder. Every part holds its share of the boundary,
+    interfaces and groups. Partitions are kept in fcache for reuse, along with
+    the evaluation caches of the subtopologies.'''
+
+    return self.fcache( self._partition, nparts, method, geometry )
+
+  def _partition( self, nparts, method, geometry ):
+    elements = self.elements if method is None else self.reorder( method, geometry ).elements
+    bounds = numpy.linspace( 0, len(self), nparts+1 ).round().astype( int )
+    return tuple( SubsetTopology( self, elements[i:j] ) for i, j in zip( bounds[:-1], bounds[1:] ) )
+
+  def reorder( self, method='rcm', geometry=None ):
+    '''Topology of the same elements ordered for locality, either in reverse
+    Cuthill-McKee order of the graph of elements that share vertices (rcm), or
+    along a Morton space-filling curve through the element centroids of
+    geometry (sfc). Bases and functions defined on this topology remain
+    valid on the result, which shares its boundary, interfaces and groups.'''
+
+    if method == 'rcm':
+      import scipy.sparse, scipy.sparse.csgraph
+      vertices = {}
+      ielems, iverts = [], []
+      for ielem, elem in enumerate( self ):
+        for vertex in elem.vertices:
+          ielems.append( ielem )
+          iverts.append( vertices.setdefault( vertex, len(vertices) ) )
+      incidence = scipy.sparse.csr_matrix( ( numpy.ones(len(ielems)), (ielems,iverts) ), shape=(len(self),len(vertices)) )
+      order = scipy.sparse.csgraph.reverse_cuthill_mckee( ( incidence * incidence.T ).tocsr(), symmetric_mode=True )
+    elif method == 'sfc':
+      assert geometry is not None, 'space-filling curve requires geometry'
+      centroids = self.elem_mean( geometry, geometry=geometry, ischeme='gauss1' )
+      nbits = 63 // self.ndims
+      lower = centroids.min( axis=0 )
+      scale = ( 2**nbits - 1 ) / numpy.maximum( centroids.max( axis=0 ) - lower, 1e-300 )
+      coords = ( ( centroids - lower ) * scale ).astype( numpy.uint64 )
+      code = numpy.zeros( len(self), dtype=numpy.uint64 )
+      for ibit in range( nbits-1, -1, -1 ):
+        for idim in range( self.ndims ):
+          code = ( code << numpy.uint64(1) ) | ( ( coords[:,idim] >> numpy.uint64(ibit) ) & numpy.uint64(1) )
+      order = numpy.argsort( code, kind='mergesort' )
+    else:
+      raise Exception( 'invalid reordering method %r' % method )
+    log.debug( 'reordered %d elements by %s' % ( len(self), method ) )
+    return SubsetTopology( self, [ self.elements[i] for i in order ] )
+
+  def _batches( self, ischeme ):
+    '''Group element indices for batched evaluation. Elements are grouped by
+    reference, transformation depth and integration scheme, and every group is
+    split in chunks of at most batchsize elements, with batchsize a property
+    that defaults to 1 (no batching). In parallel runs the batches are ordered
+    by decreasing number of points, such that costly elements, notably those of
+    trimmed domains, are evaluated first rather than delaying the loop end.'''
+
+    batchsize = core.getprop( 'batchsize', 1 )
+    if batchsize <= 1:
+      batches = [ [ielem] for ielem in range(len(self)) ]
+    else:
+      groups = {}
+      batches = []
+      for ielem, elem in enumerate( self ):
+        elemscheme = ischeme[elem] if isinstance(ischeme,dict) else ischeme
+        key = elem.reference, len(elem.transform), len(elem.opposite), elemscheme if isinstance(elemscheme,str) else id(elemscheme)
+        batch = groups.get( key )
+        if batch is None or len(batch) == batchsize:
+          batch = groups[key] = []
+          batches.append( batch )
+        batch.append( ielem )
+    if core.getprop( 'nprocs', 1 ) > 1:
+      npoints = [ len( self.fcache( elem.reference.getischeme, ischeme[elem] if isinstance(ischeme,dict) else ischeme )[0] ) for elem in self ]
+      cost = [ -sum( npoints[ielem] for ielem in batch ) for batch in batches ]
+      batches = [ batches[i] for i in numpy.argsort( cost, kind='mergesort' ) ]
+    return batches
+
   @log.title
-  def elem_eval( self, funcs, ischeme, separate=False ):
-    'element-wise evaluation'
+  def elem_eval( self, funcs, ischeme, separate=False, arguments=None ):
+    'element-wise evaluation, with arguments the values of Argument placeholders'
 
     single_arg = not isinstance(funcs,(tuple,list))
     if single_arg:
@@ -301,13 +395,20 @@ class Topology( object ):
         idata.append( function.Tuple([ ifunc, (), func ]) )
       retvals.append( retval )
     idata = function.Tuple( idata )
-    fcache = cache.CallDict()
+    fcache = self.fcache
+
+    elemcache = self.elemcache
+
+    def evalbatch( ielems ):
+      elems = [ self.elements[ielem] for ielem in ielems ]
+      for ielem, elemdata in zip( ielems, idata.eval_batch( elems, ischeme, fcache, elemcache=elemcache, arguments=arguments ) ):
+        s = slices[ielem],
+        for ifunc, index, data in elemdata:
+          retvals[ifunc][s+index] += data
 
-    __log__ = log.enumerate( 'elem', self )
-    for ielem, elem in parallel.pariter( __log__ ):
-      s = slices[ielem],
-      for ifunc, index, data in idata.eval( elem, ischeme, fcache ):
-        retvals[ifunc][s+index] += data
+    batches = self._batches( ischeme )
+    __log__ = log.iter( 'elem' if len(batches) == len(self) else 'batch', batches )
+    parallel.parfor( evalbatch, __log__, len(batches) )
 
     log.debug( 'cache', fcache.summary() )
     log.info( 'created', ', '.join( '%s(%s)' % ( retval.__class__.__name__, ','.join( str(n) for n in retval.shape ) ) for retval in retvals ) )
@@ -334,7 +435,7 @@ class Topology( object ):
       retvals.append( numpy.empty( (len(self),)+func.shape ) )
     idata = function.Tuple( idata )
 
-    fcache = cache.CallDict()
+    fcache = self.fcache
     for ielem, elem in enumerate( self ):
       ipoints, iweights = fcache( elem.reference.getischeme, ischeme[elem] if isinstance(ischeme,dict) else ischeme )
       area_data = idata.eval( elem, ischeme, fcache )
@@ -349,7 +450,45 @@ class Topology( object ):
 
     return retvals
 
-  def _integrate( self, funcs, ischeme ):
+  def _pattern( self, indexfunc, block2func, shapes ):
+    '''Evaluate indexfunc on all elements to form the offsets array of
+    _integrate, and for every function the sorted array of distinct flat
+    indices it contributes to, or its sparsity pattern in case of a matrix,
+    along with a scatter map that links every data position to its location in
+    this array. The result depends only on the dof maps and is cached in
+    patterncache for reuse in repeated assemblies.'''
+
+    offsets = numpy.zeros( ( len(block2func), len(self)+1 ), dtype=int )
+    flatindices = [ [] for iblock in range( len(block2func) ) ]
+
+    for ielem, elem in enumerate( self ):
+      for iblock, index in enumerate( indexfunc.eval( elem, None, self.fcache, elemcache=self.elemcache ) ):
+        shape = shapes[ block2func[iblock] ]
+        flat = numpy.ravel_multi_index( numpy.ix_( *index ), shape ).ravel() if index else numpy.zeros( 1, dtype=int )
+        offsets[iblock,ielem+1] = offsets[iblock,ielem] + flat.size
+        flatindices[iblock].append( flat )
+
+    # Since several blocks may belong to the same function, we post process the
+    # offsets to form consecutive intervals in longer arrays.
+
+    nvals = numpy.zeros( len(shapes), dtype=int )
+    for iblock, ifunc in enumerate( block2func ):
+      offsets[iblock] += nvals[ifunc]
+      nvals[ifunc] = offsets[iblock,-1]
+
+    patterns = []
+    for ifunc, shape in enumerate( shapes ):
+      flat = numpy.concatenate( [ numpy.zeros( 0, dtype=int ) ] + [ flat for iblock, jfunc in enumerate( block2func ) if jfunc == ifunc for flat in flatindices[iblock] ] )
+      index, scatter = numpy.unique( flat, return_inverse=True )
+      if len(index) < 2**31:
+        scatter = scatter.astype( numpy.int32 )
+      if len(shape) == 2:
+        index = matrix.SparsityPattern( index, shape )
+      patterns.append(( index, scatter ))
+
+    return offsets, patterns
+
+  def _integrate( self, funcs, ischeme, arguments=None ):
 
     # Functions may consist of several blocks, such as originating from
     # chaining. Here we make a list of all blocks consisting of triplets of
@@ -369,64 +508,51 @@ class Topology( object ):
     if core.getprop( 'dot', False ):
       valuefunc.graphviz()
 
-    fcache = cache.CallDict()
-
-    # To allocate (shared) memory for all block data we evaluate indexfunc to
-    # build an nblocks x nelems+1 offset array, and nblocks index lists of
-    # length nelems.
-
-    offsets = numpy.zeros( ( len(blocks), len(self)+1 ), dtype=int )
-    indices = [ [] for i in range( len(blocks) ) ]
+    fcache = self.fcache
 
-    for ielem, elem in enumerate( self ):
-      for iblock, index in enumerate( indexfunc.eval( elem, None, fcache ) ):
-        n = util.product( len(ind) for ind in index ) if index else 1
-        offsets[iblock,ielem+1] = offsets[iblock,ielem] + n
-        indices[iblock].append( index )
-
-    # Since several blocks may belong to the same function, we post process the
-    # offsets to form consecutive intervals in longer arrays. The length of
-    # these arrays is captured in the nfuncs-array nvals.
+    # The offsets array of nblocks x nelems+1 locates the data of every block
+    # and element in the data array of its function, and the pattern of every
+    # function holds its distinct flat indices and a scatter map from data
+    # positions to these. Both are formed from indexfunc once and then reused.
 
-    nvals = numpy.zeros( len(funcs), dtype=int )
-    for iblock, ifunc in enumerate( block2func ):
-      offsets[iblock] += nvals[ifunc]
-      nvals[ifunc] = offsets[iblock,-1]
+    offsets, patterns = self.patterncache( self._pattern, indexfunc, tuple(block2func), tuple( func.shape for func in funcs ) )
+    datas = [ parallel.shzeros( len(scatter), dtype=float ) for index, scatter in patterns ]
 
-    # The data_index list contains shared memory index and value arrays for
-    # each function argument.
+    # In a parallel element loop, valuefunc is evaluated to fill the data
+    # arrays using the offsets array for location. Each element has its own
+    # location so no locks are required.
 
-    data_index = [
-      ( parallel.shzeros( n, dtype=float ),
-        parallel.shzeros( (funcs[ifunc].ndim,n), dtype=int ) )
-            for ifunc, n in enumerate(nvals) ]
+    elemcache = self.elemcache
 
-    # In a second, parallel element loop, valuefunc is evaluated to fill the
-    # data part of data_index using the offsets array for location. Each
-    # element has its own location so no locks are required. The index part of
-    # data_index is filled in the same loop. It does not use valuefunc data but
-    # benefits from parallel speedup.
+    def integratebatch( ielems ):
+      elems = [ self.elements[ielem] for ielem in ielems ]
+      for ielem, elem, elemdata in zip( ielems, elems, valuefunc.eval_batch( elems, ischeme, fcache, optimize=True, elemcache=elemcache, arguments=arguments ) ):
+        ipoints, iweights = fcache( elem.reference.getischeme, ischeme[elem] if isinstance(ischeme,dict) else ischeme )
+        for iblock, intdata in enumerate( elemdata ):
+          s = slice(*offsets[iblock,ielem:ielem+2])
+          datas[ block2func[iblock] ][s] = numeric.dot( iweights, intdata ).ravel()
 
-    __log__ = log.enumerate( 'elem', self )
-    for ielem, elem in parallel.pariter( __log__ ):
-      ipoints, iweights = fcache( elem.reference.getischeme, ischeme[elem] if isinstance(ischeme,dict) else ischeme )
-      for iblock, intdata in enumerate( valuefunc.eval( elem, ipoints, fcache ) ):
-        s = slice(*offsets[iblock,ielem:ielem+2])
-        data, index = data_index[ block2func[iblock] ]
-        w_intdata = numeric.dot( iweights, intdata )
-        data[s] = w_intdata.ravel()
-        si = (slice(None),) + (_,) * (w_intdata.ndim-1)
-        for idim, ii in enumerate( indices[iblock][ielem] ):
-          index[idim,s].reshape(w_intdata.shape)[...] = ii[si]
-          si = si[:-1]
+    batches = self._batches( ischeme )
+    __log__ = log.iter( 'elem' if len(batches) == len(self) else 'batch', batches )
+    parallel.parfor( integratebatch, __log__, len(batches) )
 
     log.debug( 'cache', fcache.summary() )
 
-    return data_index
+    # Finally the data is summed into the distinct entries of every function,
+    # yielding values along with their sorted flat indices or pattern.
+
+    return [ ( numpy.bincount( scatter, data, len(index) ), index ) for data, (index, scatter) in zip( datas, patterns ) ]
 
   @log.title
-  def integrate( self, funcs, ischeme, geometry=None, iwscale=None, force_dense=False ):
-    'integrate'
+  def integrate( self, funcs, ischeme, geometry=None, iwscale=None, force_dense=False, blocks=None, arguments=None ):
+    '''integrate; sparse matrices are returned as block matrices if blocks is
+    given, either a sequence of block lengths or a function formed by chain,
+    and arguments holds the values of Argument placeholders by name. If the
+    comm property holds a communicator, every rank integrates only its own
+    partition, such that the index patterns and element loops are
+    distributed. The assembled results are then summed over all ranks and
+    returned whole on every rank; this is a reduction of the result, not a
+    row distribution, so every rank holds the full matrix.'''
 
     if iwscale is None:
       assert geometry is not None
@@ -435,10 +561,83 @@ class Topology( object ):
       assert iwscale is not None
     single_arg = not isinstance( funcs, (list,tuple) )
     integrands = [ funcs * iwscale ] if single_arg else [ func * iwscale for func in funcs ]
-    data_index = self._integrate( integrands, ischeme )
-    retvals = [ matrix.assemble( data, index, integrand.shape, force_dense ) for integrand, (data,index) in zip( integrands, data_index ) ]
+    comm = core.getprop( 'comm', None )
+    if comm is not None and comm.size > 1:
+      # Distributed assembly: every rank integrates its own part of the
+      # topology, after which the partial results are summed over all ranks,
+      # leaving the full result on every rank.
+      data_index = self.partition( comm.size )[ comm.rank ]._integrate( integrands, ischeme, arguments )
+      partials = [ matrix.assemble( data, index, integrand.shape, force_dense ) for integrand, (data,index) in zip( integrands, data_index ) ]
+      partials = [ matrix.ScipyMatrix( partial.core ) if isinstance( partial, matrix.ScipyMatrix ) else partial for partial in partials ] # strip patterns
+      retvals = comm.allreduce( partials, lambda partials1, partials2: [ partial1 + partial2 for partial1, partial2 in zip( partials1, partials2 ) ] )
+    else:
+      data_index = self._integrate( integrands, ischeme, arguments )
+      retvals = [ matrix.assemble( data, index, integrand.shape, force_dense ) for integrand, (data,index) in zip( integrands, data_index ) ]
+    if blocks is not None:
+      if isinstance( blocks, function.Concatenate ):
+        assert blocks.axis == 0
+        blocks = [ func.shape[0] for func in blocks.funcs ]
+      retvals = [ matrix.BlockMatrix( retval.core, blocks, retval.pattern ) if isinstance( retval, matrix.ScipyMatrix ) else retval for retval in retvals ]
     return retvals[0] if single_arg else retvals
 
+  @log.title
+  def operator( self, func, ischeme, geometry=None, iwscale=None ):
+    '''Matrix free operator of bilinear integrand func. Rather than being
+    assembled, element matrices are evaluated and applied to the dof vector on
+    every application, such that memory scales with the number of dofs instead
+    of nonzeros. In parallel runs the processes are forked once and serve all
+    applications, see parallel.parloop. The diagonal is assembled once for
+    preconditioning.'''
+
+    if iwscale is None:
+      assert geometry is not None
+      iwscale = function.iwscale( geometry, self.ndims )
+    integrand = func * iwscale
+    assert integrand.ndim == 2
+    shape = integrand.shape
+    indices, values = zip( *function.blocks( integrand ) )
+    valuefunc = function.Tuple( values )
+    fcache = self.fcache
+    elemcache = self.elemcache
+    elemindices = [ function.Tuple( indices ).eval( elem, None, fcache, elemcache=elemcache ) for elem in self ]
+    batches = self._batches( ischeme )
+
+    # The parallel loop is set up once and served by the same processes on
+    # every application, with the dof vector, the choice between application
+    # (0) and diagonal (1), and the per process results in shared memory.
+    nprocs = core.getprop( 'nprocs', 1 )
+    vec = parallel.shzeros( shape[1] )
+    mode = parallel.shzeros( 1, dtype=int )
+    partial = parallel.shzeros( ( nprocs, shape[0] ) )
+
+    def elemvec( elemmat, rows, cols ):
+      if not mode[0]:
+        return rows, elemmat.dot( vec[cols] )
+      irow, icol = numpy.where( rows[:,_] == cols )
+      return rows[irow], elemmat[irow,icol]
+
+    def accumulatebatch( ielems ):
+      # Every process or thread accumulates into its own row to avoid locking.
+      iproc = parallel.workerid()
+      elems = [ self.elements[ielem] for ielem in ielems ]
+      for ielem, elem, elemdata in zip( ielems, elems, valuefunc.eval_batch( elems, ischeme, fcache, optimize=True, elemcache=elemcache ) ):
+        ipoints, iweights = fcache( elem.reference.getischeme, ischeme[elem] if isinstance(ischeme,dict) else ischeme )
+        for (rows, cols), intdata in zip( elemindices[ielem], elemdata ):
+          irows, values = elemvec( numeric.dot( iweights, intdata ), rows, cols )
+          partial[iproc,irows] += values
+
+    loop = parallel.parloop( accumulatebatch, batches )
+
+    def accumulate( imode, v=None ):
+      mode[0] = imode
+      if v is not None:
+        vec[:] = v
+      partial[:] = 0
+      loop()
+      return partial.sum( axis=0 )
+
+    return matrix.MatrixFree( lambda v: accumulate( 0, v ), accumulate( 1 ), shape )
+
   @log.title
   def integrate_symm( self, funcs, ischeme, geometry=None, iwscale=None, force_dense=False ):
     'integrate a symmetric integrand on a product domain' # TODO: find a proper home for this
@@ -465,6 +664,8 @@ class Topology( object ):
     tri_data_index = Topology( trielems, self.ndims )._integrate( integrands, ischeme )
     retvals = []
     for integrand, (diagdata,diagindex), (tridata,triindex) in zip( integrands, diag_data_index, tri_data_index ):
+      diagindex = numpy.unravel_index( diagindex.index, integrand.shape )
+      triindex = numpy.unravel_index( triindex.index, integrand.shape )
       data = numpy.concatenate( [ diagdata, tridata, tridata ], axis=0 )
       index = numpy.concatenate( [ diagindex, triindex, triindex[::-1] ], axis=1 )
       retvals.append( matrix.assemble( data, index, integrand.shape, force_dense ) )
@@ -1224,6 +1425,35 @@ class RefinedTopology( Topology ):
   def boundary( self ):
     return self.basetopo.boundary.refined
 
+class SubsetTopology( Topology ):
+  '''elements of basetopo, reordered or a subset thereof, with bases taken
+  from basetopo and boundary, interfaces and groups restricted to the
+  elements'''
+
+  def __init__( self, basetopo, elements ):
+    self.basetopo = basetopo
+    Topology.__init__( self, elements, basetopo.ndims )
+
+  def _restrict( self, topo ):
+    if len(self) == len(self.basetopo):
+      return topo
+    elements = [ elem for elem in topo if elem.transform.lookup( self.edict ) ]
+    return SubsetTopology( topo, elements ) if elements else Topology( elements, topo.ndims )
+
+  def __getitem__( self, key ):
+    return self._restrict( self.basetopo[key] )
+
+  @cache.property
+  def boundary( self ):
+    return self._restrict( self.basetopo.boundary )
+
+  @cache.property
+  def interfaces( self ):
+    return self._restrict( self.basetopo.interfaces )
+
+  def basis( self, name, *args, **kwargs ):
+    return self.basetopo.basis( name, *args, **kwargs )
+
 class TrimmedTopology( Topology ):
   'trimmed'
 
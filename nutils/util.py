@@ -342,6 +342,9 @@ def run( *functions ):
 
   properties = {
     'nprocs': 1,
+    'threads': False,
+    'nranks': 1,
+    'batchsize': 1,
     'outdir': '~/public_html',
     'verbose': 6,
     'richoutput': False,
@@ -349,6 +352,10 @@ def run( *functions ):
     'imagetype': 'png',
     'symlink': False,
     'recache': False,
+    'cachesize': 1024,
+    'fcachesize': 256,
+    'patterncachesize': 1024,
+    'shmsize': 1024,
     'dot': False,
     'profile': False,
   }
@@ -365,6 +372,10 @@ def run( *functions ):
     print( '''
   --help                  Display this help
   --nprocs=%(nprocs)-14s Select number of processors
+  --threads=%(threads)-13s Use threads rather than processes in parfor
+                          loops; pariter loops then run serially
+  --nranks=%(nranks)-14s Select number of ranks of a local cluster
+  --batchsize=%(batchsize)-11s Set number of elements evaluated at once
   --outdir=%(outdir)-14s Define directory for output
   --verbose=%(verbose)-13s Set verbosity level, 9=all
   --richoutput=%(richoutput)-10s Use rich output (colors, unicode)
@@ -372,6 +383,10 @@ def run( *functions ):
   --imagetype=%(imagetype)-11s Set image type
   --symlink=%(symlink)-13s Create symlink to latest results
   --recache=%(recache)-13s Overwrite existing cache
+  --cachesize=%(cachesize)-11s Set maximum cache size in megabytes
+  --fcachesize=%(fcachesize)-10s Set evaluation cache size in megabytes
+  --patterncachesize=%(patterncachesize)-4s Set sparsity pattern cache size in megabytes
+  --shmsize=%(shmsize)-13s Set shared memory size of pools in megabytes
   --dot=%(dot)-17s Set graphviz executable
   --profile=%(profile)-13s Show profile summary at exit''' % properties )
     for i, func in enumerate( functions ):
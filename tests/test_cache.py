@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+from nutils import *
+import numpy, tempfile, shutil, os
+
+calls = []
+
+def func( n, scale=1. ):
+  calls.append( n )
+  return numpy.arange( n ) * scale
+
+class TestFileCache( object ):
+
+  def setUp( self ):
+    self.cachedir = tempfile.mkdtemp()
+    del calls[:]
+
+  def tearDown( self ):
+    shutil.rmtree( self.cachedir )
+
+  def filecache( self, cachesize=1024 ):
+    __cachedir__ = self.cachedir
+    __cachesize__ = cachesize
+    return cache.FileCache( 'test' )
+
+  def test_random_access( self ):
+    fcache = self.filecache()
+    a = fcache( func, 10 )
+    fcache( func, 20, scale=2. )
+    b = fcache( func, 10 )
+    numpy.testing.assert_array_equal( a, b )
+    c = self.filecache()( func, 20, scale=2. )
+    numpy.testing.assert_array_equal( c, numpy.arange(20)*2. )
+    assert calls == [ 10, 20 ]
+    assert fcache.hit == 1 and fcache.miss == 2
+
+  def test_lambda( self ):
+    fcache = self.filecache()
+    assert fcache( lambda n: n + 1, 10 ) == 11
+    assert fcache( lambda n: n - 1, 10 ) == 9
+    assert fcache( lambda n: n + 1, 10 ) == 11
+    assert fcache.hit == 1 and fcache.miss == 2
+
+  def test_closure( self ):
+    fcache = self.filecache()
+    def shift( offset ):
+      def f( n ):
+        return n + offset
+      return f
+    assert fcache( shift(1), 10 ) == 11
+    assert fcache( shift(2), 10 ) == 12
+    assert fcache.hit == 0 and fcache.miss == 2
+
+  def test_eviction( self ):
+    fcache = self.filecache( cachesize=1 )
+    for n in 100000, 100001, 100002:
+      fcache( func, n )
+    assert fcache.evicted == 2
+    assert len( os.listdir( self.cachedir ) ) == 1
+    fcache( func, 100002 )
+    assert calls == [ 100000, 100001, 100002 ]
+
+  def test_mmap( self ):
+    fcache = self.filecache()
+    a, b = fcache( func, 100000 ), fcache( func, 10 )
+    a_, b_ = self.filecache()( func, 100000 ), self.filecache()( func, 10 )
+    assert isinstance( a_, numpy.memmap ) and not isinstance( b_, numpy.memmap )
+    numpy.testing.assert_array_equal( a, a_ )
+    numpy.testing.assert_array_equal( b, b_ )
+    a_[0] = 1 # copy on write
+    numpy.testing.assert_array_equal( self.filecache()( func, 100000 ), a )
+    assert calls == [ 100000, 10 ]
+
+class TestLRUCache( object ):
+
+  def setUp( self ):
+    del calls[:]
+
+  def test_content( self ):
+    lru = cache.LRUCache( 2**20 )
+    a = numpy.arange( 10 )
+    b = numpy.arange( 10 )
+    assert lru( numpy.cumsum, a )[-1] == 45
+    lru( numpy.cumsum, b )
+    assert lru.hit == 1 and lru.miss == 1
+    a[-1] = 0 # modified in place
+    assert lru( numpy.cumsum, a )[-1] == 36
+    assert lru.hit == 1 and lru.miss == 2
+    assert lru.nbytes == 2 * a.nbytes # values only, arguments are keyed by digest
+
+  def test_strided( self ):
+    lru = cache.LRUCache( 2**20 )
+    a = numpy.arange( 20 )
+    assert lru( numpy.cumsum, a[::2] )[-1] == 90
+    assert lru( numpy.cumsum, a[::2].copy() )[-1] == 90
+    assert lru( numpy.cumsum, a[1::2] )[-1] == 100
+    assert lru.hit == 1 and lru.miss == 2
+
+  def test_identity( self ):
+    lru = cache.LRUCache( 2**20 )
+    a = numpy.arange( 10 )
+    b = numpy.arange( 10 )
+    a.flags.writeable = b.flags.writeable = False
+    lru( numpy.sum, a )
+    lru( numpy.sum, a )
+    lru( numpy.sum, b )
+    assert lru.hit == 1 and lru.miss == 2
+
+  def test_readonly( self ):
+    lru = cache.LRUCache( 2**20 )
+    value = lru( func, 10 )
+    assert not value.flags.writeable
+
+  def test_eviction( self ):
+    lru = cache.LRUCache( 2000 )
+    for n in 100, 100, 200, 100, 200:
+      lru( func, n )
+    assert calls == [ 100, 200, 100, 200 ]
+    assert lru.evicted == 3 and lru.nbytes == 1600
+    lru( func, 1000 ) # too large to be kept
+    lru( func, 200 )
+    assert calls == [ 100, 200, 100, 200, 1000 ]
+
+class Op( object ):
+  pass
+
+class TestOperationCache( object ):
+
+  def test_eviction( self ):
+    opcache = cache.OperationCache( 2000 )
+    ops = [ Op(), Op() ]
+    opcache[ops[0],1] = numpy.zeros( 100 )
+    opcache[ops[1],1] = numpy.zeros( 100 )
+    opcache[ops[0],1] # most recently used
+    opcache[ops[0],2] = numpy.zeros( 100 )
+    assert opcache.evicted == 1 and opcache.nbytes == 1600
+    assert opcache[ops[0],1].size == 100
+    try:
+      opcache[ops[1],1]
+    except KeyError:
+      pass
+    else:
+      raise AssertionError( 'expected eviction' )
+    opcache[ops[0],3] = numpy.zeros( 1000 ) # too large to be kept
+    assert len( opcache ) == 2
+
+  def test_release( self ):
+    opcache = cache.OperationCache( 2000 )
+    op = Op()
+    opcache[op,None] = numpy.zeros( 100 )
+    del op
+    opcache[Op(),None] = numpy.zeros( 10 )
+    assert opcache.nbytes == 80 and len( opcache.order ) == 1
@@ -323,4 +323,272 @@ class TestEig( FuncTest ):
     FuncTest.__init__( self, lambda a: function.eig(a,symmetric=False)[1], lambda a: numpy.array([ numpy.linalg.eig(ai)[1] for ai in a ]), (3,3) )
   
 
+# TABULATION
+
+class TestTabulation( object ):
+
+  def __init__( self ):
+    self.std = element.PolyLine( element.PolyLine.bernstein_poly( 3 ) )**2
+    self.ref = element.SimplexReference(1)**2
+
+  def test_memoized( self ):
+    points, weights = self.ref.getischeme( 'gauss4' )
+    assert self.ref.getischeme( 'gauss4' )[0] is points
+    assert not points.flags.writeable
+    values = self.std.tabulate( points, 1 )
+    assert self.std.tabulate( points, 1 ) is values
+    numpy.testing.assert_array_almost_equal( values, self.std.eval( points, 1 ) )
+
+  def test_writeable( self ):
+    points = numpy.random.uniform( size=(5,2) )
+    ntables = len( element._tables )
+    self.std.tabulate( points )
+    assert len( element._tables ) == ntables
+    points[:] = .5 # modified in place
+    numpy.testing.assert_array_almost_equal( self.std.tabulate( points ), self.std.eval( points ) )
+
+  def test_release( self ):
+    points = numpy.random.uniform( size=(5,2) )
+    points.flags.writeable = False
+    ntables = len( element._tables )
+    self.std.tabulate( points )
+    assert len( element._tables ) == ntables+1
+    del points
+    assert len( element._tables ) == ntables
+
+# OPTIMIZATION
+
+class TestSerialized( object ):
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,3)]*2 )
+    basis = domain.splinefunc( degree=2 )
+    u = basis.dot( numpy.arange( basis.shape[0], dtype=float ) )
+    self.func = ( basis.grad(geom) * u.grad(geom) ).sum(-1) * ( 1 + u**2 ) + basis * u
+
+  def test_order( self ):
+    ops, inds = self.func.serialized
+    assert len( inds ) == len( ops ) + 1
+    assert len( set( map( id, ops ) ) ) == len( ops ) and self.func not in ops
+    for iop, indices in enumerate( inds ):
+      assert all( 0 <= i < len(function.TOKENS)+iop for i in indices )
+
+  def test_deep( self ):
+    func = self.func
+    for i in range( 2000 ):
+      func = function.sin( func )
+    ops, inds = func.serialized
+    assert len( ops ) == len( self.func.serialized[0] ) + 2000
+
+  def test_graphstats( self ):
+    ops, inds = self.func.serialized
+    stats = self.func.graphstats
+    assert stats['nops'] == len(ops) + 1
+    assert sum( stats['classes'].values() ) == stats['nops']
+    assert stats['classes']['DofIndex'] == 1
+    assert 1 < stats['depth'] <= stats['nops']
+    assert function.sin( self.func ).graphstats['depth'] == stats['depth'] + 1
+
+class TestOptimizedPlan( object ):
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,3)]*2 )
+    basis = domain.splinefunc( degree=2 )
+    iwscale = function.Iwscale()
+    self.func = function.Tuple([
+      ( basis * geom[0] ) * iwscale * ( iwscale + 1 ),
+      function.Align( function.Align( basis, [0], 2 ), [1,0], 2 ) ])
+    self.elems = list( domain )
+
+  def test_eval( self ):
+    for elem in self.elems:
+      for value, optvalue in zip( self.func.eval( elem, 'gauss2' ), self.func.eval( elem, 'gauss2', optimize=True ) ):
+        numpy.testing.assert_array_almost_equal( value, optvalue )
+
+  def test_batch( self ):
+    values = self.func.eval_batch( self.elems, 'gauss2' )
+    optvalues = self.func.eval_batch( self.elems, 'gauss2', optimize=True )
+    for value, optvalue in zip( values, optvalues ):
+      for v, optv in zip( value, optvalue ):
+        numpy.testing.assert_array_almost_equal( v, optv )
+
+  def test_ops( self ):
+    plan = self.func.optimizedplan
+    assert len( plan ) < len( self.func.plan )
+    assert not any( isinstance( op, function.Align ) and isinstance( plan.ops[i-len(function.TOKENS)], function.Align )
+      for op, args in zip( plan.ops, plan.args ) for i in args if i >= len(function.TOKENS) )
+
+class TestOptimizedIntegrands( object ):
+  'Compare optimized against unoptimized evaluation of assembly integrands.'
+
+  def __init__( self ):
+    domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,4)]*2 )
+    self.basis = domain.splinefunc( degree=2 )
+    self.elems = list( domain )
+
+  def _compare( self, func ):
+    for elem in self.elems:
+      numpy.testing.assert_array_almost_equal( func.eval( elem, 'gauss3', optimize=True ), func.eval( elem, 'gauss3' ), decimal=12 )
+    for value, optvalue in zip( func.eval_batch( self.elems, 'gauss3' ), func.eval_batch( self.elems, 'gauss3', optimize=True ) ):
+      numpy.testing.assert_array_almost_equal( optvalue, value, decimal=12 )
+
+  def test_grad( self ):
+    self._compare( self.basis.grad( self.geom ) * function.iwscale( self.geom, 2 ) )
+
+  def test_dot( self ):
+    u = self.basis.dot( numpy.arange( self.basis.shape[0], dtype=float ) )
+    self._compare( ( self.basis.grad( self.geom ) * u.grad( self.geom ) ).sum(-1) * function.iwscale( self.geom, 2 ) )
+
+  def test_take( self ):
+    dydy = function.take( function.outer( self.basis.grad( self.geom ) ), [1], axis=2 )
+    self._compare( dydy * function.iwscale( self.geom, 2 ) )
+
+  def test_findargs( self ):
+    func = self.basis.grad( self.geom )
+    for op in func.optimizedplan.ops:
+      if isinstance( op, cache.Immutable ):
+        assert type(op)( *cache.findargs( op ) ) is op
+
+class TestProfile( object ):
+
+  def __init__( self ):
+    self.domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,4)]*2 )
+    basis = self.domain.splinefunc( degree=2 )
+    self.func = function.sin( basis.dot( numpy.arange( basis.shape[0], dtype=float ) ) )
+
+  def test_integrate( self ):
+    __evalprofile__ = profile = function.Profile()
+    self.domain.integrate( self.func, geometry=self.geom, ischeme='gauss2' )
+    classes = profile.byclass()
+    t, ncalls, nbytes = classes['Pointwise']
+    assert ncalls > 0 and nbytes > 0
+    assert numpy.isclose( sum( t for t, n, b in classes.values() ), profile.total )
+    profile.log()
+
+  def test_eval( self ):
+    elem = next( iter( self.domain ) )
+    nbytes = self.func.eval( elem, 'gauss2' ).nbytes
+    __evalprofile__ = profile = function.Profile()
+    for i in range( 3 ):
+      self.func.eval( elem, 'gauss2' )
+    ops, inds = self.func.serialized
+    assert profile.calls[self.func] == 3
+    assert profile.nbytes[self.func] == 3 * nbytes
+    assert all( profile.calls[op] == 3 for op in ops )
+    lines = self.func.stackstr( profile=profile ).splitlines()
+    assert all( '3x' in line for line in lines[len(function.TOKENS):] )
+
+class TestRenumber( object ):
+
+  def __init__( self ):
+    self.domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,9)]*2 )
+    numpy.random.seed(0)
+    basis = self.domain.splinefunc( degree=2 )
+    shuffle = numpy.random.permutation( basis.shape[0] )
+    nmap = { trans: shuffle[dofs] for trans, dofs in basis.dofmap.dofmap.items() }
+    self.basis = function.Inflate( basis.func, function.DofMap( nmap, axis=basis.dofmap.shape[0] ), length=basis.length, axis=0 )
+
+  def laplace( self, basis ):
+    A = function.outer( basis.grad(self.geom) ).sum(-1) + function.outer( basis )
+    return self.domain.integrate( [ A, basis ], geometry=self.geom, ischeme='gauss3' )
+
+  def bandwidth( self, A ):
+    rows, cols = A.toscipy().nonzero()
+    return numpy.max( abs( rows - cols ) )
+
+  def test_renumber( self ):
+    A, b = self.laplace( self.basis )
+    cons = self.domain.boundary['left'].project( 1, onto=self.basis, geometry=self.geom, ischeme='gauss3' )
+    lhs = A.solve( b, constrain=cons )
+    for method in 'rcm', 'nd':
+      basis, perm = function.renumber( self.basis, method )
+      assert sorted( perm ) == list( range( len(perm) ) )
+      Ap, bp = self.laplace( basis )
+      numpy.testing.assert_array_almost_equal( Ap.toarray(), A.toarray()[numpy.ix_(perm,perm)], decimal=14 )
+      lhsp = numpy.empty_like( lhs )
+      lhsp[perm] = Ap.solve( bp, constrain=cons[perm] )
+      numpy.testing.assert_array_almost_equal( lhsp, lhs, decimal=12 )
+    assert self.bandwidth( self.laplace( function.renumber( self.basis, 'rcm' )[0] )[0] ) < self.bandwidth( A ) / 2
+
+class TestDerivative( object ):
+
+  def __init__( self ):
+    self.domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,4)]*2 )
+    self.vbasis, self.pbasis = function.chain([ self.domain.splinefunc( degree=2 ).vector( 2 ), self.domain.splinefunc( degree=1 ) ])
+    self.lhs = function.Argument( 'lhs', self.vbasis.shape[0] )
+    u = self.vbasis.dot( self.lhs )
+    p = self.pbasis.dot( self.lhs )
+    self.res = ( self.vbasis * ( u.grad(self.geom) * u ).sum(-1) ).sum(-1) - self.vbasis.div(self.geom) * function.exp( p ) \
+      + self.pbasis * u.div(self.geom) + ( self.pbasis.grad(self.geom) * p.grad(self.geom) ).sum(-1) * p**2
+    self.jac = function.derivative( self.res, self.lhs )
+
+  def check_jacobian( self, lhs ):
+    r, J = self.domain.integrate( [ self.res, self.jac ], geometry=self.geom, ischeme='gauss5', arguments=dict( lhs=lhs ) )
+    assert isinstance( J, matrix.ScipyMatrix )
+    eps = 1e-7
+    for i in range( 0, len(lhs), 7 ):
+      dlhs = lhs.copy()
+      dlhs[i] += eps
+      dr = ( self.domain.integrate( self.res, geometry=self.geom, ischeme='gauss5', arguments=dict( lhs=dlhs ) ) - r ) / eps
+      numpy.testing.assert_array_almost_equal( J.toarray()[:,i], dr, decimal=5 )
+
+  def test_random( self ):
+    self.check_jacobian( numpy.random.RandomState( 0 ).normal( size=self.lhs.shape[0] ) )
+
+  def test_ones( self ):
+    self.check_jacobian( numpy.ones( self.lhs.shape[0] ) )
+
+  def test_zeros( self ):
+    self.check_jacobian( numpy.zeros( self.lhs.shape[0] ) )
+
+  def test_linear( self ):
+    u = self.vbasis.dot( self.lhs )
+    M = self.domain.integrate( ( self.vbasis[:,_,:] * self.vbasis[_,:,:] ).sum(-1), geometry=self.geom, ischeme='gauss5' )
+    J = self.domain.integrate( function.derivative( ( self.vbasis * u ).sum(-1), self.lhs ), geometry=self.geom, ischeme='gauss5' )
+    numpy.testing.assert_array_almost_equal( J.toarray(), M.toarray() )
+
+  def test_unsupported( self ):
+    class Unsupported( function.ArrayFunc ):
+      def __init__( self, func ):
+        function.ArrayFunc.__init__( self, args=[func], shape=func.shape )
+    u = self.vbasis.dot( self.lhs )
+    try:
+      function.derivative( Unsupported( u ), self.lhs )
+    except NotImplementedError as e:
+      assert 'Unsupported' in str(e)
+    else:
+      raise AssertionError( 'expected NotImplementedError' )
+    assert function.derivative( u, self.lhs ) is function.derivative( u, self.lhs ) # no state left behind
+    try:
+      function.derivative( u, numpy.zeros( self.lhs.shape[0] ) )
+    except TypeError:
+      pass
+    else:
+      raise AssertionError( 'expected TypeError' )
+
+  def test_threads( self ):
+    import threading
+    results = {}
+    def differentiate( i ):
+      results[i] = function.derivative( self.res, self.lhs ) if i % 2 else self.res.grad( self.geom )
+    threads = [ threading.Thread( target=differentiate, args=(i,) ) for i in range( 8 ) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elem = next( iter( self.domain ) )
+    arguments = dict( lhs=numpy.random.RandomState( 0 ).normal( size=self.lhs.shape[0] ) )
+    for i, func in ( 0, self.res.grad( self.geom ) ), ( 1, self.jac ):
+      value = func.eval( elem, 'gauss2', arguments=arguments )
+      for j in range( i, 8, 2 ):
+        numpy.testing.assert_array_almost_equal( results[j].eval( elem, 'gauss2', arguments=arguments ), value, decimal=12 )
+
+  def test_dedup( self ):
+    lhs = function.Argument( 'lhs', self.vbasis.shape[0] )
+    assert lhs is self.lhs and self.vbasis.dot( lhs ) is self.vbasis.dot( self.lhs )
+
+  def test_independent( self ):
+    d = function.derivative( self.vbasis * self.geom[0], self.lhs )
+    assert d.shape == self.vbasis.shape + self.lhs.shape and not function.blocks( d )
+
 # vim:shiftwidth=2:foldmethod=indent:foldnestmax=2
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+from nutils import *
+import numpy, time, os
+
+class TestPool( object ):
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=2 )
+
+  def newton( self, nsteps ):
+    lhs = numpy.zeros( self.basis.shape[0] )
+    matrices = []
+    for istep in range( nsteps ):
+      u = self.basis.dot( lhs )
+      A, b = self.domain.integrate( [ function.outer( self.basis ) * ( 1 + u**2 ), self.basis ], geometry=self.geom, ischeme='gauss3' )
+      lhs = A.solve( b )
+      matrices.append( A.toarray() )
+    return matrices, parallel.parmap( numpy.sum, matrices )
+
+  def test_pool( self ):
+    serial = self.newton( 3 )
+    __nprocs__ = 3
+    pooled = parallel.pool( self.newton )( 3 )
+    for A1, A2 in zip( serial[0], pooled[0] ):
+      numpy.testing.assert_array_almost_equal( A1, A2, decimal=13 )
+    numpy.testing.assert_array_almost_equal( serial[1], pooled[1], decimal=13 )
+
+  def test_reuse( self ):
+    def allocate( n ):
+      return [ parallel.shzeros( 1000 ).__array_interface__['data'][0] for i in range( n ) ]
+    __nprocs__ = 2
+    addresses = parallel.pool( allocate )( 3 )
+    assert len( set( addresses ) ) == 1
+
+  def test_failure( self ):
+    def fail():
+      assert parallel.ismaster()
+      return list( parallel.pariter( range( 4 ) ) )
+    __nprocs__ = 2
+    try:
+      parallel.pool( fail )()
+    except Exception:
+      pass
+    else:
+      raise AssertionError( 'failure in pool did not propagate' )
+
+  def test_break( self ):
+    def loops():
+      for i in parallel.pariter( range( 100 ) ):
+        if parallel.ismaster():
+          break
+        time.sleep( .005 ) # such that all processes claim items
+      return sum( parallel.parmap( lambda i: i, range( 10 ) ) )
+    __nprocs__ = 3
+    assert parallel.pool( loops )() == 45
+
+  def test_overflow( self ):
+    def allocate():
+      small = parallel.shzeros( 2**16 )
+      large = parallel.shzeros( 2**18 ) # exceeds the arena of 1MB
+      for i in parallel.pariter( range( len(large) ) ):
+        large[i] = i
+      return large.sum()
+    __nprocs__ = 2
+    __shmsize__ = 1
+    assert parallel.pool( allocate )() == numpy.arange( 2**18 ).sum()
+
+class TestScheduling( object ):
+
+  def __init__( self ):
+    domain, self.geom = mesh.rectilinear( [numpy.linspace(-1,1,7)]*2 )
+    self.domain, complement = domain.trim( levelset=1-(self.geom**2).sum(-1)*3, maxrefine=2 )
+
+  def test_parmap( self ):
+    __nprocs__ = 3
+    squares = parallel.parmap( lambda i: i**2, range( 100 ) )
+    numpy.testing.assert_array_equal( squares, numpy.arange( 100 )**2 )
+
+  def test_order( self ):
+    __nprocs__ = 2
+    batches = self.domain._batches( 'gauss2' )
+    npoints = [ len( self.domain.elements[ielem].reference.getischeme( 'gauss2' )[0] ) for ielem, in batches ]
+    assert npoints == sorted( npoints, reverse=True ) and npoints[0] > npoints[-1]
+
+  def test_trimmed( self ):
+    integrands = [ self.geom**2, self.geom[0]**4 ]
+    serial = self.domain.integrate( integrands, geometry=self.geom, ischeme='gauss2' )
+    __nprocs__ = 2
+    forked = self.domain.integrate( integrands, geometry=self.geom, ischeme='gauss2' )
+    for v1, v2 in zip( serial, forked ):
+      numpy.testing.assert_array_almost_equal( v1, v2, decimal=13 )
+
+class TestThreads( object ):
+
+  def __init__( self ):
+    domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,9)]*2 )
+    self.domain = domain
+    self.basis = domain.splinefunc( degree=2 )
+
+  def test_integrate( self ):
+    integrands = [ function.outer( self.basis.grad(self.geom) ).sum(-1), self.basis * self.geom[0] ]
+    A1, b1 = self.domain.integrate( integrands, geometry=self.geom, ischeme='gauss3' )
+    __nprocs__ = 3
+    __threads__ = True
+    A3, b3 = self.domain.integrate( integrands, geometry=self.geom, ischeme='gauss3' )
+    numpy.testing.assert_array_almost_equal( A1.toarray(), A3.toarray(), decimal=13 )
+    numpy.testing.assert_array_almost_equal( b1, b3, decimal=13 )
+
+  def test_parmap( self ):
+    __nprocs__ = 3
+    __threads__ = True
+    __scale__ = 2
+    values = parallel.parmap( lambda i: core.getprop( 'scale' ) * i, range( 100 ) )
+    numpy.testing.assert_array_equal( values, numpy.arange( 100 ) * 2 )
+
+  def test_failure( self ):
+    __nprocs__ = 3
+    __threads__ = True
+    try:
+      parallel.parmap( lambda i: 1 // ( i - 50 ), range( 100 ) )
+    except ZeroDivisionError:
+      pass
+    else:
+      raise AssertionError( 'exception in thread did not propagate' )
+
+  def test_lrucache( self ):
+    lru = cache.LRUCache( 20000 )
+    __nprocs__ = 4
+    __threads__ = True
+    parallel.parfor( lambda i: lru( numpy.zeros, i % 37 * 10 ), range( 2000 ) )
+    assert lru.nbytes == sum( entry[1] for entry in lru.entries.values() ) <= 20000
+    assert lru.evicted
+
+  def test_elemcache( self ):
+    integrand = function.outer( self.basis.grad(self.geom) ).sum(-1)
+    A1 = self.domain.integrate( integrand, geometry=self.geom, ischeme='gauss3' )
+    __nprocs__ = 3
+    __threads__ = True
+    for i in range( 2 ): # cold and warm cache
+      A3 = self.domain.integrate( integrand, geometry=self.geom, ischeme='gauss3' )
+      numpy.testing.assert_array_almost_equal( A1.toarray(), A3.toarray(), decimal=13 )
+      assert len( self.domain.elemcache )
+
+class TestShared( object ):
+
+  def test_dtypes( self ):
+    __nprocs__ = 3
+    for dtype in bool, numpy.int64, numpy.float32, complex:
+      values = parallel.parmap( lambda i: i % 2 * 1j if dtype == complex else i % 2, range( 20 ), dtype=dtype )
+      assert values.dtype == dtype
+      numpy.testing.assert_array_equal( values, numpy.arange( 20 ) % 2 * ( 1j if dtype == complex else 1 ) )
+
+  def test_large_int( self ):
+    __nprocs__ = 2
+    values = parallel.parmap( lambda i: i * 2**40, range( 4 ), dtype=int )
+    numpy.testing.assert_array_equal( values, numpy.arange( 4 ) * 2**40 )
+
+  def reduce( self ):
+    total = parallel.parreduce( lambda i: numpy.arange( 3 ) * i, range( 100 ), shape=(3,), dtype=int )
+    maximum = parallel.parreduce( lambda i: -( i - 30 )**2, range( 100 ), op=numpy.maximum )
+    return total, maximum
+
+  def test_reduce( self ):
+    __nprocs__ = 3
+    for threads in False, True:
+      __threads__ = threads
+      total, maximum = self.reduce()
+      numpy.testing.assert_array_equal( total, numpy.arange( 3 ) * 4950 )
+      assert maximum == 0
+    total, maximum = parallel.pool( self.reduce )()
+    numpy.testing.assert_array_equal( total, numpy.arange( 3 ) * 4950 )
+    assert maximum == 0
+
+class TestParLoop( object ):
+
+  def test_loop( self ):
+    __nprocs__ = 3
+    counts = parallel.shzeros( 20, dtype=int )
+    def count( i ):
+      counts[i] += 1
+    loop = parallel.parloop( count, range( 20 ) )
+    for n in 1, 2:
+      loop()
+      numpy.testing.assert_array_equal( counts, n )
+    loop.close()
+
+  def check_failure( self, func ):
+    __nprocs__ = 2
+    def call( i ):
+      time.sleep( .005 ) # such that all processes claim items
+      if parallel.workerid():
+        func()
+    loop = parallel.parloop( call, range( 20 ) )
+    try:
+      loop()
+    except Exception:
+      pass
+    else:
+      raise AssertionError( 'failure in parallel loop did not propagate' )
+    loop.close()
+
+  def test_raise( self ):
+    def fail():
+      raise ValueError( 'expected failure' )
+    self.check_failure( fail )
+
+  def test_exit( self ):
+    self.check_failure( lambda: os._exit( 1 ) )
+
+class TestCluster( object ):
+
+  def __init__( self ):
+    domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,7)]*2 )
+    self.domain = domain
+    self.basis = domain.splinefunc( degree=2 )
+
+  def integrate( self ):
+    integrands = [ function.outer( self.basis.grad(self.geom) ).sum(-1), self.basis * self.geom[0], self.geom[1]**2 ]
+    return self.domain.integrate( integrands, geometry=self.geom, ischeme='gauss3' )
+
+  def test_integrate( self ):
+    A1, b1, c1 = self.integrate()
+    __nranks__ = 3
+    A3, b3, c3 = parallel.localcluster( self.integrate )()
+    numpy.testing.assert_array_almost_equal( A1.toarray(), A3.toarray(), decimal=13 )
+    numpy.testing.assert_array_almost_equal( b1, b3, decimal=13 )
+    numpy.testing.assert_almost_equal( c1, c3, decimal=13 )
+
+  def test_collectives( self ):
+    def collect():
+      comm = core.getprop( 'comm' )
+      total = comm.allreduce( numpy.array([ comm.rank, 1 ]), lambda a, b: a + b )
+      assert comm.bcast( comm.rank ) == 0
+      return total
+    for nranks in 2, 3, 5:
+      __nranks__ = nranks
+      total = parallel.localcluster( collect )()
+      numpy.testing.assert_array_equal( total, [ nranks*(nranks-1)//2, nranks ] )
+
+  def test_failure( self ):
+    def fail():
+      comm = core.getprop( 'comm' )
+      assert comm.rank != 1
+      return comm.allreduce( 1, lambda a, b: a + b )
+    __nranks__ = 3
+    try:
+      parallel.localcluster( fail )()
+    except Exception:
+      pass
+    else:
+      raise AssertionError( 'failure in rank did not propagate' )
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+from nutils import *
+import numpy
+
+class TestNewton( object ):
+
+  def __init__( self ):
+    self.domain, self.geom = mesh.rectilinear( [numpy.linspace(0,1,7)]*2 )
+    basis = self.domain.splinefunc( degree=2 )
+    self.cons = self.domain.boundary['left'].project( 0, onto=basis, geometry=self.geom, ischeme='gauss4' )
+    self.lhs = function.Argument( 'lhs', basis.shape[0] )
+    u = basis.dot( self.lhs )
+    self.res = ( basis.grad(self.geom) * u.grad(self.geom) ).sum(-1) * ( 1 + u**2 ) + basis * ( u**3 - 10 )
+    self.jac = function.derivative( self.res, self.lhs )
+
+  def solve( self, **kwargs ):
+    lhs0 = numpy.zeros( self.lhs.shape[0] )
+    return solver.newton( self.domain, self.res, self.lhs, lhs0, 'gauss4', geometry=self.geom, constrain=self.cons, jacobian=self.jac, info=True, **kwargs )
+
+  def check_converged( self, lhs ):
+    res = self.domain.integrate( self.res, geometry=self.geom, ischeme='gauss4', arguments=dict( lhs=lhs ) )
+    numpy.testing.assert_almost_equal( res[numpy.isnan(self.cons)], 0, decimal=10 )
+    numpy.testing.assert_almost_equal( lhs[~numpy.isnan(self.cons)], 0 )
+
+  def test_residual( self ):
+    lhs, info = self.solve()
+    self.check_converged( lhs )
+    assert info['njac'] == info['niter'] + 1 # full newton
+    assert info['history'][-1] <= 1e-10 < info['history'][0]
+
+  def test_defaultjacobian( self ):
+    lhs, info = self.solve()
+    lhs_ = solver.newton( self.domain, self.res, self.lhs, numpy.zeros(self.lhs.shape[0]), 'gauss4', geometry=self.geom, constrain=self.cons )
+    numpy.testing.assert_almost_equal( lhs, lhs_ )
+
+  def test_lag( self ):
+    lhs, info = self.solve( lag=1 )
+    for lag in 0, 2, 3:
+      lhs_, info_ = self.solve( lag=lag, linesearch=True )
+      self.check_converged( lhs_ )
+      numpy.testing.assert_array_almost_equal( lhs, lhs_, decimal=8 )
+      assert info_['njac'] < info['njac']
+      assert info_['njac'] <= info_['niter']
+
+  def test_nolinesearch( self ):
+    lhs, info = self.solve( lag=2, linesearch=False )
+    self.check_converged( lhs )
+    assert info['njac'] < info['niter'] + 1
+
+  def test_iterative( self ):
+    lhs, info = self.solve()
+    lhs_, info_ = self.solve( lag=3, solvetol=1e-12, precon='spilu' )
+    self.check_converged( lhs_ )
+    numpy.testing.assert_almost_equal( lhs, lhs_, decimal=8 )
+    assert info_['njac'] < info['njac']
+
+# vim:shiftwidth=2:foldmethod=indent:foldnestmax=2
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from nutils import *
-import numpy, copy
+import numpy, copy, pickle
 
 grid = numpy.linspace( 0., 1., 4 )
 
@@ -106,6 +106,297 @@ class TestStructure2D( object ):
       xn = bnd.elem_eval( geom.dotnorm(geom), ischeme='gauss1', separate=False )
       numpy.testing.assert_array_less( 0, xn, 'inward pointing normals' )
 
+class TestBatchedEvaluation( object ):
+  'Compare batched against element-by-element evaluation.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=2 )
+    numpy.random.seed(0)
+    self.u = self.basis.dot( numpy.random.normal( size=self.basis.shape[0] ) )
+
+  def integrate( self, batchsize ):
+    __batchsize__ = batchsize
+    A = function.outer( self.basis.grad(self.geom) ).sum(-1) * function.exp( self.u )
+    b = self.basis * function.sin( self.geom[0] )
+    return self.domain.integrate( [ A, b, self.u**2 ], geometry=self.geom, ischeme='gauss3' )
+
+  def elem_eval( self, batchsize ):
+    __batchsize__ = batchsize
+    return self.domain.elem_eval( [ self.u.grad(self.geom), self.geom ], ischeme='gauss2', separate=True )
+
+  def test_integrate( self ):
+    A1, b1, c1 = self.integrate( 1 )
+    A4, b4, c4 = self.integrate( 4 )
+    numpy.testing.assert_array_almost_equal( A1.toarray(), A4.toarray(), decimal=13 )
+    numpy.testing.assert_array_almost_equal( b1, b4, decimal=13 )
+    numpy.testing.assert_almost_equal( c1, c4, decimal=13 )
+
+  def test_elem_eval( self ):
+    for v1, v4 in zip( self.elem_eval( 1 ), self.elem_eval( 4 ) ):
+      numpy.testing.assert_array_almost_equal( v1, v4, decimal=13 )
+
+class TestElementCache( object ):
+  'Compare integration with warm and cold element cache.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,4)]*2 )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=2 )
+    numpy.random.seed(0)
+
+  def integrate( self, lhs, batchsize ):
+    __batchsize__ = batchsize
+    u = self.basis.dot( lhs )
+    return self.domain.integrate( self.basis * function.exp( u ), geometry=self.geom, ischeme='gauss3' )
+
+  def test_repeated( self ):
+    for batchsize in 1, 4:
+      self.domain.elemcache.clear()
+      self.integrate( numpy.random.normal( size=self.basis.shape[0] ), batchsize )
+      assert self.domain.elemcache
+      lhs = numpy.random.normal( size=self.basis.shape[0] )
+      warm = self.integrate( lhs, batchsize )
+      self.domain.elemcache.clear()
+      cold = self.integrate( lhs, batchsize )
+      numpy.testing.assert_array_almost_equal( warm, cold, decimal=15 )
+
+  def test_kinds( self ):
+    plan = ( self.basis * function.Iwscale() ).plan
+    kinds = dict( zip( plan.ops, plan.kinds ) )
+    assert kinds[ function.Iwscale() ] == plan.ELEMENT
+    assert kinds[ plan.evaluable ] == plan.POINTWISE
+    assert all( kind != plan.POINTWISE for kind in plan.kinds[:plan.nelemops] )
+
+class TestAssembly( object ):
+  'Compare sparse assembly from a reused pattern against dense assembly.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,4)]*2 )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=2 ).vector( 2 )
+
+  def test_pattern( self ):
+    A = function.outer( self.basis.grad(self.geom) ).sum([-1,-2])
+    dense = self.domain.integrate( A, geometry=self.geom, ischeme='gauss3', force_dense=True )
+    npatterns = len( self.domain.patterncache )
+    for i in range( 2 ):
+      sparse, b = self.domain.integrate( [ A * (i+1), self.basis.sum(-1) ], geometry=self.geom, ischeme='gauss3' )
+      numpy.testing.assert_array_almost_equal( sparse.toarray(), dense.toarray() * (i+1), decimal=13 )
+      assert sparse.core.has_canonical_format
+      numpy.testing.assert_almost_equal( b.sum(), 2, decimal=13 )
+    assert len( self.domain.patterncache ) == npatterns + 1
+
+  def test_update( self ):
+    A = function.outer( self.basis.grad(self.geom) ).sum([-1,-2])
+    A1 = self.domain.integrate( A, geometry=self.geom, ischeme='gauss3' )
+    A2 = self.domain.integrate( A * 2, geometry=self.geom, ischeme='gauss3' )
+    assert A1.pattern is A2.pattern
+    assert numpy.may_share_memory( A1.core.indices, A2.core.indices ) and not A1.core.indices.flags.writeable
+    assert not numpy.may_share_memory( A1.core.data, A2.core.data )
+    A1.update( A2.core.data )
+    numpy.testing.assert_array_equal( A1.toarray(), A2.toarray() )
+
+  def test_precon( self ):
+    A = function.outer( self.basis ).sum(-1) + function.outer( self.basis.grad(self.geom) ).sum([-1,-2])
+    cons = numpy.empty( self.basis.shape[0] )
+    cons[:] = numpy.nan
+    cons[:4] = 1
+    rhs = numpy.ones( self.basis.shape[0] )
+    for scale in 1, 2:
+      M = self.domain.integrate( A * scale, geometry=self.geom, ischeme='gauss3' )
+      exact = M.solve( rhs, constrain=cons )
+      for name in 'splu', 'spilu':
+        x = M.solve( rhs, constrain=cons, tol=1e-10, precon=name )
+        numpy.testing.assert_array_almost_equal( x, exact, decimal=8 )
+    assert len( M.pattern.cache ) == 1
+    select, subpattern = M.pattern.submatrix( numpy.isnan(cons), numpy.isnan(cons) )
+    assert ( 'permc', 'splu' ) in subpattern.cache and ( 'permc', 'spilu' ) in subpattern.cache
+
+  def test_direct( self ):
+    A = function.outer( self.basis ).sum(-1) + function.outer( self.basis.grad(self.geom) ).sum([-1,-2])
+    M = self.domain.integrate( A, geometry=self.geom, ischeme='gauss3' )
+    cons = numpy.empty( self.basis.shape[0] )
+    cons[:] = numpy.nan
+    cons[:4] = 1
+    I = numpy.isnan( cons )
+    rhs = numpy.random.RandomState( 0 ).normal( size=(self.basis.shape[0],3) )
+    dense = M.toarray()
+    X = M.solve( rhs, constrain=cons )
+    assert X.shape == rhs.shape
+    for x, b in zip( X.T, rhs.T ):
+      numpy.testing.assert_array_equal( x[~I], 1 )
+      numpy.testing.assert_array_almost_equal( dense[I].dot( x ), b[I], decimal=12 )
+      numpy.testing.assert_array_almost_equal( M.solve( b, constrain=cons ), x, decimal=12 )
+    assert len( M._factors ) == 1
+    assert M.factorize( constrain=cons ) is M.factorize( constrain=cons )
+    M.update( M.core.data * 2 )
+    assert not M._factors
+    numpy.testing.assert_array_almost_equal( M.solve( rhs*2, constrain=cons ), X, decimal=12 )
+
+  def test_pickle( self ):
+    A = function.outer( self.basis ).sum(-1) + function.outer( self.basis.grad(self.geom) ).sum([-1,-2])
+    M = self.domain.integrate( A, geometry=self.geom, ischeme='gauss3' )
+    rhs = numpy.ones( self.basis.shape[0] )
+    x = M.solve( rhs )
+    assert M._factors
+    M_ = pickle.loads( pickle.dumps( M, pickle.HIGHEST_PROTOCOL ) )
+    assert M._factors and not M_._factors
+    numpy.testing.assert_array_almost_equal( M_.solve( rhs ), x, decimal=12 )
+
+  def test_amg( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,17)]*2 )
+    basis = domain.splinefunc( degree=1 )
+    A = function.outer( basis.grad(geom) ).sum(-1)
+    cons = domain.boundary['left'].project( 0, onto=basis, geometry=geom, ischeme='gauss2' )
+    rhs = numpy.ones( basis.shape[0] )
+    for scale in 1, 2:
+      M = domain.integrate( A * scale, geometry=geom, ischeme='gauss2' )
+      exact = M.solve( rhs, constrain=cons )
+      niter = {}
+      for name in 'diag', 'amg':
+        residuals = []
+        x = M.solve( rhs, constrain=cons, tol=1e-10, symmetric=True, precon=name, callback=residuals.append )
+        numpy.testing.assert_array_almost_equal( x, exact, decimal=8 )
+        niter[name] = len( residuals )
+      assert niter['amg'] < niter['diag'] / 2
+    select, subpattern = M.pattern.submatrix( numpy.isnan(cons), numpy.isnan(cons) )
+    assert 'amg' in subpattern.cache
+
+class TestBlockMatrix( object ):
+  'Solve a Taylor-Hood Stokes system with block preconditioners.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,7)]*2 )
+    vbasis, pbasis = function.chain([ domain.stdfunc( degree=2 ).vector( 2 ), domain.stdfunc( degree=1 ) ])
+    A = function.outer( vbasis.grad(geom) ).sum([-1,-2]) - function.outer( vbasis.div(geom), pbasis ) - function.outer( pbasis, vbasis.div(geom) )
+    self.matrix, self.rhs = domain.integrate( [ A, vbasis[:,0] ], geometry=geom, ischeme='gauss4', blocks=vbasis )
+    self.cons = domain.boundary.project( 0, onto=vbasis, geometry=geom, ischeme='gauss4' )
+    self.cons[ self.matrix.offsets[1] ] = 0
+    self.nvelo = vbasis.funcs[0].shape[0]
+
+  def test_blocks( self ):
+    assert isinstance( self.matrix, matrix.BlockMatrix )
+    numpy.testing.assert_array_equal( self.matrix.offsets, [ 0, self.nvelo, self.matrix.shape[0] ] )
+    numpy.testing.assert_array_equal( self.matrix.block(1,0).toarray(), self.matrix.toarray()[self.nvelo:,:self.nvelo] )
+    assert not self.matrix.block(1,1).toarray().any()
+
+  def test_precon( self ):
+    exact = self.matrix.solve( self.rhs, constrain=self.cons )
+    for name, maxiter in ( 'blocktriangular', 30 ), ( 'schur', 30 ), ( 'schur:spilu', 30 ), ( 'schur:amg', 50 ):
+      residuals = []
+      x = self.matrix.solve( self.rhs, constrain=self.cons, tol=1e-10, precon=name, callback=residuals.append )
+      numpy.testing.assert_array_almost_equal( x, exact, decimal=8 )
+      assert len( residuals ) < maxiter
+
+  def test_zerodiagonal( self ):
+    # pressure block first: its zero diagonal cannot be inverted
+    n = self.matrix.shape[0]
+    perm = numpy.concatenate([ numpy.arange( self.nvelo, n ), numpy.arange( self.nvelo ) ])
+    swapped = matrix.BlockMatrix( self.matrix.core[perm,:][:,perm], [ n-self.nvelo, self.nvelo ] )
+    for name in 'blocktriangular', 'schur':
+      try:
+        swapped.getprecon( name, constrain=self.cons[perm] )
+      except Exception as e:
+        assert 'nonzero diagonals' in str(e)
+      else:
+        raise AssertionError( 'zero diagonal not detected' )
+
+class TestOperator( object ):
+  'Compare matrix free operator application against the assembled matrix.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=3 )
+    A = function.outer( self.basis.grad(geom) ).sum(-1) + function.outer( self.basis )
+    self.matrix = domain.integrate( A, geometry=geom, ischeme='gauss4' )
+    self.operator = domain.operator( A, geometry=geom, ischeme='gauss4' )
+
+  def test_matvec( self ):
+    v = numpy.random.RandomState( 0 ).normal( size=self.basis.shape[0] )
+    numpy.testing.assert_array_almost_equal( self.operator.matvec( v ), self.matrix.matvec( v ), decimal=13 )
+    numpy.testing.assert_array_almost_equal( self.operator.diagonal, self.matrix.toscipy().diagonal(), decimal=13 )
+
+  def test_solve( self ):
+    cons = self.domain.boundary['left'].project( 0, onto=self.basis, geometry=self.geom, ischeme='gauss4' )
+    rhs = numpy.ones( self.basis.shape[0] )
+    x = self.operator.solve( rhs, constrain=cons, tol=1e-10, symmetric=True )
+    numpy.testing.assert_array_almost_equal( x, self.matrix.solve( rhs, constrain=cons ), decimal=8 )
+
+  def test_invalid( self ):
+    rhs = numpy.ones( self.basis.shape[0] )
+    for args, kwargs in ( (rhs,), {} ), ( (rhs,), dict( tol=1e-10, solver='direct' ) ), ( (rhs[:,numpy.newaxis],), dict( tol=1e-10 ) ):
+      try:
+        self.operator.solve( *args, **kwargs )
+      except Exception as e:
+        assert 'matrix free operator' in str(e)
+      else:
+        raise AssertionError( 'expected an exception' )
+
+  def test_parallel( self ):
+    __nprocs__ = 2
+    A = function.outer( self.basis.grad(self.geom) ).sum(-1) + function.outer( self.basis )
+    operator = self.domain.operator( A, geometry=self.geom, ischeme='gauss4' )
+    numpy.testing.assert_array_almost_equal( operator.diagonal, self.operator.diagonal, decimal=13 )
+    for seed in 0, 1: # served by the same processes
+      v = numpy.random.RandomState( seed ).normal( size=self.basis.shape[0] )
+      numpy.testing.assert_array_almost_equal( operator.matvec( v ), self.matrix.matvec( v ), decimal=13 )
+
+class TestReorder( object ):
+  'Reorder a shuffled topology for locality.'
+
+  def __init__( self ):
+    domain, geom = mesh.rectilinear( [numpy.linspace(0,1,9)]*2 )
+    numpy.random.seed(0)
+    self.shuffled = topology.Topology( [ domain.elements[i] for i in numpy.random.permutation(len(domain)) ], domain.ndims )
+    self.domain = domain
+    self.geom = geom
+    self.basis = domain.splinefunc( degree=2 )
+
+  def spread( self, topo ):
+    ielems = {}
+    for ielem, elem in enumerate( topo ):
+      for vertex in elem.vertices:
+        ielems.setdefault( vertex, [] ).append( ielem )
+    return numpy.mean([ max(i) - min(i) for i in ielems.values() ])
+
+  def test_reorder( self ):
+    A = function.outer( self.basis )
+    A0 = self.shuffled.integrate( A, geometry=self.geom, ischeme='gauss3' )
+    for method in 'rcm', 'sfc':
+      topo = self.shuffled.reorder( method, geometry=self.geom )
+      assert set( topo ) == set( self.shuffled )
+      assert self.spread( topo ) < self.spread( self.shuffled ) / 2
+      numpy.testing.assert_array_almost_equal( topo.integrate( A, geometry=self.geom, ischeme='gauss3' ).toarray(), A0.toarray(), decimal=14 )
+
+  def test_partition( self ):
+    parts = self.shuffled.partition( 4, 'sfc', self.geom )
+    assert parts is self.shuffled.partition( 4, 'sfc', self.geom )
+    assert sorted( len(part) for part in parts ) == [ 16 ] * 4
+    assert set( elem for part in parts for elem in part ) == set( self.shuffled )
+    for part in parts: # every part is a contiguous 4x4 block
+      xmin, xmax = numpy.sort( part.elem_mean( self.geom, geometry=self.geom, ischeme='gauss1' ), axis=0 )[[0,-1]]
+      numpy.testing.assert_array_almost_equal( xmax - xmin, [ .375, .375 ] )
+
+  def test_attributes( self ):
+    topo = self.domain.reorder( 'sfc', geometry=self.geom )
+    assert topo.boundary is self.domain.boundary
+    assert topo.boundary['left'] is self.domain.boundary['left']
+    assert topo.interfaces is self.domain.interfaces
+    assert topo.splinefunc( degree=2 ) == self.basis
+    parts = self.domain.partition( 4, 'sfc', self.geom )
+    for name in 'boundary', 'interfaces':
+      elems = [ elem for part in parts for elem in getattr( part, name ) ]
+      assert len( elems ) == len( getattr( self.domain, name ) ) and set( elems ) == set( getattr( self.domain, name ) )
+    assert sum( len( part.boundary['left'] ) for part in parts ) == len( self.domain.boundary['left'] ) == 8
+    assert all( len( part.boundary['left'] ) in ( 0, 4 ) for part in parts )
+
 def visualinspect():
   'Visual inspection of StokesBEM test case.'
   visual = TestTopologyGlueing()